@@ -2,45 +2,211 @@
 美颜算法API模块 - 基于dlib的人脸检测和美化算法
 """
 import cv2
-import numpy as np
 import dlib
+import numpy as np
 import os
+from collections import OrderedDict
+from collections.abc import Mapping
 from typing import Tuple, Dict, List, Optional
+from api.face_models import PREDICTOR_PATH, get_detector, get_predictor
+from api.landmark_store import get_landmark_store, pixel_digest
+
+# 美颜中间层缓存（HSV 图、双边滤波结果等）的内存预算
+BEAUTIFY_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 256 MB
+
+# 器官遮罩边缘羽化的高斯核大小，遮罩在多边形外接矩形外至多扩散半个核
+ORGAN_MASK_BLUR = 15
+
+class MaskTile:
+    """裁剪到外接矩形的遮罩：tile 为矩形内的数据，offset 为其左上角在原图中的位置 (y, x)，矩形外全为 0"""
+    def __init__(self, tile: np.ndarray, offset: Tuple[int, int], shape: Tuple[int, int]):
+        self.tile = tile
+        self.offset = offset
+        self.shape = shape  # 原图尺寸 (height, width)
+    
+    @property
+    def roi(self) -> Optional[Tuple[slice, slice]]:
+        """遮罩在原图中的外接矩形，遮罩为空时返回 None"""
+        if self.tile.size == 0:
+            return None
+        y, x = self.offset
+        return slice(y, y + self.tile.shape[0]), slice(x, x + self.tile.shape[1])
+    
+    @property
+    def nbytes(self) -> int:
+        return self.tile.nbytes
+    
+    def overlap(self, roi: Tuple[slice, slice]) -> Optional[Tuple[Tuple[slice, slice], np.ndarray]]:
+        """
+        遮罩与原图矩形 roi 的重叠部分
+        Returns:
+            (重叠部分在 roi 内的位置, 重叠部分的遮罩数据)，不重叠时返回 None
+        """
+        if self.tile.size == 0:
+            return None
+        y, x = self.offset
+        y0, y1 = max(roi[0].start, y), min(roi[0].stop, y + self.tile.shape[0])
+        x0, x1 = max(roi[1].start, x), min(roi[1].stop, x + self.tile.shape[1])
+        if y1 <= y0 or x1 <= x0:
+            return None
+        dst = (slice(y0 - roi[0].start, y1 - roi[0].start), slice(x0 - roi[1].start, x1 - roi[1].start))
+        return dst, self.tile[y0 - y:y1 - y, x0 - x:x1 - x]
+    
+    def crop(self, roi: Tuple[slice, slice]) -> np.ndarray:
+        """取出原图矩形 roi 内的遮罩（roi 在遮罩矩形内时返回视图）"""
+        y, x = self.offset
+        if (roi[0].start >= y and roi[0].stop <= y + self.tile.shape[0] and
+                roi[1].start >= x and roi[1].stop <= x + self.tile.shape[1]):
+            return self.tile[roi[0].start - y:roi[0].stop - y, roi[1].start - x:roi[1].stop - x]
+        
+        result = np.zeros((roi[0].stop - roi[0].start, roi[1].stop - roi[1].start), dtype=self.tile.dtype)
+        overlap = self.overlap(roi)
+        if overlap is not None:
+            result[overlap[0]] = overlap[1]
+        return result
+    
+    def full(self) -> np.ndarray:
+        """展开为原图大小的遮罩"""
+        return self.crop((slice(0, self.shape[0]), slice(0, self.shape[1])))
+
+class OrganMasks(Mapping):
+    """按需生成的器官遮罩：第一次访问某个器官时才计算，结果为 MaskTile"""
+    def __init__(self, beautifier: 'FaceBeautifier', image_bgr: np.ndarray, landmarks: np.ndarray,
+                 organs_points: Dict):
+        self._beautifier = beautifier
+        self._image_bgr = image_bgr
+        self._landmarks = landmarks
+        self._organs_points = organs_points
+        self._names = list(organs_points) + ['forehead', 'face']
+        self._masks = {}
+    
+    def __getitem__(self, name: str) -> MaskTile:
+        mask = self._masks.get(name)
+        if mask is not None:
+            return mask
+        if name not in self._names:
+            raise KeyError(name)
+        
+        beautifier = self._beautifier
+        if name == 'forehead':
+            # 计算完整的额头区域
+            forehead_landmarks = beautifier._get_forehead_landmark(self._image_bgr, self._landmarks, self)
+            self._organs_points['forehead'] = forehead_landmarks
+            mask = beautifier._create_organ_mask(self._image_bgr, forehead_landmarks)
+        elif name == 'face':
+            # 整个脸部区域
+            self._organs_points['face'] = list(range(0, 68))
+            mask = beautifier._create_organ_mask(self._image_bgr, self._landmarks)
+        else:
+            mask = beautifier._create_organ_mask(self._image_bgr, self._landmarks[self._organs_points[name]])
+        self._masks[name] = mask
+        return mask
+    
+    def __contains__(self, name) -> bool:
+        return name in self._names
+    
+    def __iter__(self):
+        return iter(self._names)
+    
+    def __len__(self) -> int:
+        return len(self._names)
+    
+    @property
+    def nbytes(self) -> int:
+        """已生成的遮罩占用的字节数"""
+        return sum(mask.nbytes for mask in self._masks.values())
 
 class FaceBeautifier:
-    def __init__(self, predictor_path: str):
+    def __init__(self, predictor_path: str = PREDICTOR_PATH, max_cache_bytes: int = BEAUTIFY_CACHE_MAX_BYTES):
         """
         初始化美颜器
         Args:
-            predictor_path: dlib人脸特征点检测模型路径
+            predictor_path: dlib人脸特征点检测模型路径（模型由 face_models 注册表共享，首次使用时加载）
+            max_cache_bytes: 与强度无关的中间层缓存的内存预算
         """
         self.predictor_path = predictor_path
-        self.detector = dlib.get_frontal_face_detector()
-        self.predictor = dlib.shape_predictor(predictor_path)
+        self.max_cache_bytes = max_cache_bytes
+        # (层名称, 输入内容键, 参数) -> 中间层，按最近使用排序
+        # 输入内容键为 (源图像素哈希, 已应用的效果...)，由调用方沿处理流程推导，不对中间结果重复计算哈希
+        self._layer_cache = OrderedDict()
+
+    @property
+    def detector(self):
+        """当前线程的人脸检测器"""
+        return get_detector()
+
+    @property
+    def predictor(self):
+        """进程内共享的特征点模型"""
+        return get_predictor(self.predictor_path)
         
-    def detect_faces(self, image_path: str) -> Tuple[np.ndarray, List[Dict]]:
+    def detect_faces(self, image, digest: Optional[str] = None) -> Tuple[np.ndarray, List[Dict]]:
         """
         检测人脸并提取特征点
         Args:
-            image_path: 图片路径
+            image: 图片路径，或已解码的 BGR 图像（不会被修改）
+            digest: 可选，已知的图像像素哈希（见 landmark_store.pixel_digest）
         Returns:
             (image_bgr, faces_data): 图片数据和检测到的人脸信息列表
         """
-        # 读取图片
-        image_bgr = cv2.imread(image_path)
-        if image_bgr is None:
-            raise ValueError(f"无法读取图片: {image_path}")
+        if isinstance(image, np.ndarray):
+            image_bgr = image
+        else:
+            # 读取图片
+            image_bgr = cv2.imread(image)
+            if image_bgr is None:
+                raise ValueError(f"无法读取图片: {image}")
+            digest = None
         
-        # 转换为RGB进行检测
-        image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-        faces_data = []
+        # 获取所有人脸的68个特征点（按像素内容查表，未命中时在RGB图上检测）
+        all_landmarks = get_landmark_store().find_landmarks(image_bgr, self.detector, self.predictor, digest)
         
-        # 检测人脸
-        rects = self.detector(image_rgb, 1)
+        return image_bgr, self.build_faces_data(image_bgr, all_landmarks)
+    
+    def prepare_masks(self, faces_data: List[Dict]):
+        """预先生成美颜效果会用到的器官遮罩（遮罩默认在第一次使用时生成，可在后台线程中提前调用）"""
+        for face_data in faces_data:
+            organs_masks = face_data['organs_masks']
+            for name in ('face', 'forehead', 'left_brow', 'right_brow', 'left_eye', 'right_eye', 'mouth'):
+                if name in organs_masks:
+                    organs_masks[name]
+    
+    def create_preview_proxy(self, image_bgr: np.ndarray, faces_data: List[Dict],
+                             max_size: Tuple[int, int] = (350, 350)) -> Tuple[np.ndarray, List[Dict], float]:
+        """
+        生成实时预览用的缩小代理图
+        按比例缩小到 max_size 以内，特征点按同一比例缩放后重新生成器官遮罩，不再进行人脸检测
+        Returns:
+            (proxy_bgr, proxy_faces_data, scale): scale 为代理图相对原图的缩放比例（传给 apply_beautify 的 detail_scale）
+        """
+        height, width = image_bgr.shape[:2]
+        scale = min(max_size[0] / width, max_size[1] / height)
+        new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        proxy_bgr = cv2.resize(image_bgr, new_size, interpolation=cv2.INTER_AREA)
         
-        for i, rect in enumerate(rects):
-            # 获取68个特征点
-            landmarks = np.array([[p.x, p.y] for p in self.predictor(image_rgb, rect).parts()])
+        # 特征点坐标按实际缩放比例映射到代理图
+        scale_x, scale_y = new_size[0] / width, new_size[1] / height
+        proxy_landmarks = [
+            np.round(face_data['landmarks'] * [scale_x, scale_y]).astype(np.int64)
+            for face_data in faces_data
+        ]
+        return proxy_bgr, self.build_faces_data(proxy_bgr, proxy_landmarks), scale
+    
+    def build_faces_data(self, image_bgr: np.ndarray, all_landmarks: List[np.ndarray]) -> List[Dict]:
+        """
+        由已知的人脸特征点生成器官区域和遮罩
+        Args:
+            image_bgr: BGR图像
+            all_landmarks: 每张人脸的 (68, 2) 特征点
+        Returns:
+            人脸信息列表（与 detect_faces 返回的 faces_data 相同）
+        """
+        faces_data = []
+        
+        for i, landmarks in enumerate(all_landmarks):
+            # 人脸区域取特征点的外接矩形
+            x, y, w, h = cv2.boundingRect(landmarks.astype(np.int32))
+            rect = dlib.rectangle(x, y, x + w - 1, y + h - 1)
             
             # 定义器官区域
             organs_points = {
@@ -53,23 +219,8 @@ class FaceBeautifier:
                 'right_brow': list(range(22, 27))
             }
             
-            # 为每个器官生成遮罩
-            organs_masks = {}
-            for organ_name, points in organs_points.items():
-                mask = self._create_organ_mask(image_bgr, landmarks[points])
-                organs_masks[organ_name] = mask
-            
-            # 计算完整的额头区域
-            mask_organs = self._combine_organ_masks(organs_masks, ['mouth', 'nose', 'left_eye', 'right_eye', 'left_brow', 'right_brow'])
-            mask_nose = organs_masks['nose']
-            forehead_landmarks = self._get_forehead_landmark(image_bgr, landmarks, mask_organs, mask_nose)
-            
-            organs_points['forehead'] = forehead_landmarks
-            organs_masks['forehead'] = self._create_organ_mask(image_bgr, forehead_landmarks)
-            
-            # 整个脸部区域
-            organs_points['face'] = list(range(0, 68))
-            organs_masks['face'] = self._create_organ_mask(image_bgr, landmarks)
+            # 器官遮罩（含额头和整个脸部）在效果第一次用到时才生成，只保存外接矩形内的部分
+            organs_masks = OrganMasks(self, image_bgr, landmarks, organs_points)
             
             face_data = {
                 'index': i,
@@ -81,20 +232,13 @@ class FaceBeautifier:
             
             faces_data.append(face_data)
         
-        return image_bgr, faces_data
-    
-    def _combine_organ_masks(self, organs_masks, organ_names):
-        """合并器官遮罩"""
-        combined_mask = np.zeros(organs_masks[list(organs_masks.keys())[0]].shape, dtype=np.float64)
-        for name in organ_names:
-            if name in organs_masks:
-                combined_mask = np.maximum(combined_mask, organs_masks[name])
-        return combined_mask
+        return faces_data
     
-    def _get_forehead_landmark(self, im_bgr: np.ndarray, face_landmark: np.ndarray, 
-                              mask_organs: np.ndarray, mask_nose: np.ndarray) -> np.ndarray:
+    def _get_forehead_landmark(self, im_bgr: np.ndarray, face_landmark: np.ndarray, organs_masks) -> np.ndarray:
         """
         完整的额头区域检测（基于椭圆模型和肤色检测）
+        所有计算都限制在椭圆的外接矩形内，结果与整图计算完全一致
+        organs_masks: 器官遮罩（MaskTile），用于剔除五官和统计鼻子肤色
         """
         # 画椭圆定位额头大致区域
         radius = (np.linalg.norm(face_landmark[0] - face_landmark[16]) / 2).astype('int32')
@@ -103,32 +247,48 @@ class FaceBeautifier:
         angle = np.degrees(np.arctan((face_landmark[16] - face_landmark[0])[1] / 
                                    (face_landmark[16] - face_landmark[0])[0])).astype('int32')
         
-        mask = np.zeros(mask_organs.shape[:2], dtype=np.float64)
-        cv2.ellipse(mask, center_abs, (radius, radius), angle, 180, 360, 1, -1)
-        
-        # 剔除与五官重合部分
-        mask[mask_organs > 0] = 0
-        
-        # 根据鼻子的肤色判断真正的额头面积
-        index_bool = []
-        for ch in range(3):
-            nose_pixels = im_bgr[:, :, ch][mask_nose > 0]
-            if len(nose_pixels) > 0:
-                mean, std = np.mean(nose_pixels), np.std(nose_pixels)
-                up, down = mean + 0.5 * std, mean - 0.5 * std
-                index_bool.append((im_bgr[:, :, ch] < down) | (im_bgr[:, :, ch] > up))
-            else:
-                index_bool.append(np.zeros(im_bgr.shape[:2], dtype=bool))
-        
-        if index_bool:
-            index_zero = ((mask > 0) & index_bool[0] & index_bool[1] & index_bool[2])
-            mask[index_zero] = 0
-        
-        # 获取额头区域的凸包
-        index_abs = np.array(np.where(mask > 0)[::-1]).transpose()
-        if len(index_abs) > 0:
-            landmark = cv2.convexHull(index_abs).squeeze()
-        else:
+        # 椭圆（任意旋转角度）一定落在以圆心为中心、边长为直径的正方形内，多留 1 像素的光栅化余量
+        center = (int(center_abs[0]), int(center_abs[1]))
+        roi = self._pad_roi((slice(center[1], center[1] + 1), slice(center[0], center[0] + 1)),
+                            int(radius) + 1, im_bgr.shape)
+        
+        landmark = None
+        if roi[0].stop > roi[0].start and roi[1].stop > roi[1].start:
+            y0, x0 = roi[0].start, roi[1].start
+            mask = np.zeros((roi[0].stop - y0, roi[1].stop - x0), dtype=np.float64)
+            cv2.ellipse(mask, (center[0] - x0, center[1] - y0), (radius, radius), angle, 180, 360, 1, -1)
+            
+            # 剔除与五官重合部分
+            mask_organs = np.zeros(mask.shape, dtype=np.uint8)
+            for name in ['mouth', 'nose', 'left_eye', 'right_eye', 'left_brow', 'right_brow']:
+                if name in organs_masks:
+                    self._max_into(mask_organs, roi, organs_masks[name])
+            mask[mask_organs > 0] = 0
+            
+            # 根据鼻子的肤色判断真正的额头面积（鼻子遮罩之外都是 0，按行优先取出的像素与整图相同）
+            mask_nose = organs_masks['nose']
+            im_roi = im_bgr[roi]
+            index_bool = []
+            for ch in range(3):
+                nose_pixels = im_bgr[mask_nose.roi][:, :, ch][mask_nose.tile > 0] if mask_nose.roi is not None else []
+                if len(nose_pixels) > 0:
+                    mean, std = np.mean(nose_pixels), np.std(nose_pixels)
+                    up, down = mean + 0.5 * std, mean - 0.5 * std
+                    index_bool.append((im_roi[:, :, ch] < down) | (im_roi[:, :, ch] > up))
+                else:
+                    index_bool.append(np.zeros(mask.shape, dtype=bool))
+            
+            if index_bool:
+                index_zero = ((mask > 0) & index_bool[0] & index_bool[1] & index_bool[2])
+                mask[index_zero] = 0
+            
+            # 获取额头区域的凸包
+            ys, xs = np.where(mask > 0)
+            index_abs = np.array([xs + x0, ys + y0]).transpose()
+            if len(index_abs) > 0:
+                landmark = cv2.convexHull(index_abs).squeeze()
+        
+        if landmark is None:
             # 如果检测失败，使用简化方法作为备选
             points = face_landmark[[17, 18, 19, 20, 21, 22, 23, 24, 25, 26]]
             landmark = points.copy()
@@ -136,22 +296,39 @@ class FaceBeautifier:
         
         return landmark.astype(np.int32)
     
-    def _create_organ_mask(self, image_bgr: np.ndarray, points: np.ndarray) -> np.ndarray:
-        """创建器官遮罩"""
-        mask = np.zeros(image_bgr.shape[:2], dtype=np.uint8)
+    def _create_organ_mask(self, image_bgr: np.ndarray, points: np.ndarray) -> MaskTile:
+        """
+        创建器官遮罩
+        只保留凸包外接矩形向外扩展半个高斯核的范围（范围外模糊后仍为 0）；
+        模糊时再向外多取半个核，使边界反射只读到 0，结果与整图生成完全一致
+        """
+        height, width = image_bgr.shape[:2]
+        empty = MaskTile(np.zeros((0, 0), dtype=np.uint8), (0, 0), (height, width))
+        if len(points) <= 2:
+            return empty
+        
+        # 创建凸包
+        hull = cv2.convexHull(points.astype(np.int32))
+        x, y, w, h = cv2.boundingRect(hull)
+        pad = ORGAN_MASK_BLUR // 2
+        roi = self._pad_roi((slice(y, y + h), slice(x, x + w)), pad, (height, width))
+        if roi[0].stop <= roi[0].start or roi[1].stop <= roi[1].start:
+            return empty
+        blur_roi = self._pad_roi(roi, pad, (height, width))
         
-        if len(points) > 2:
-            # 创建凸包
-            hull = cv2.convexHull(points.astype(np.int32))
-            cv2.fillConvexPoly(mask, hull, 255)
+        mask = np.zeros((blur_roi[0].stop - blur_roi[0].start, blur_roi[1].stop - blur_roi[1].start), dtype=np.uint8)
+        cv2.fillConvexPoly(mask, hull - np.array([blur_roi[1].start, blur_roi[0].start], dtype=np.int32), 255)
         
         # 高斯模糊使边缘柔和
-        mask = cv2.GaussianBlur(mask, (15, 15), 0)
-        return mask
+        mask = cv2.GaussianBlur(mask, (ORGAN_MASK_BLUR, ORGAN_MASK_BLUR), 0)
+        mask = mask[roi[0].start - blur_roi[0].start:roi[0].stop - blur_roi[0].start,
+                    roi[1].start - blur_roi[1].start:roi[1].stop - blur_roi[1].start].copy()
+        return MaskTile(mask, (roi[0].start, roi[1].start), (height, width))
     
     def apply_beautify(self, image_bgr: np.ndarray, faces_data: List[Dict], 
                       whitening: float = 0, smoothing: float = 0, 
-                      bright_eyes: float = 0, red_lips: float = 0) -> np.ndarray:
+                      bright_eyes: float = 0, red_lips: float = 0, detail_scale: float = 1.0,
+                      digest: Optional[str] = None) -> np.ndarray:
         """
         应用美颜效果
         Args:
@@ -161,123 +338,252 @@ class FaceBeautifier:
             smoothing: 磨皮程度 0-100  
             bright_eyes: 亮眼程度 0-100
             red_lips: 红唇程度 0-100
+            detail_scale: 图像相对原图的缩放比例（预览代理图小于 1），磨皮的滤波窗口按比例缩小
+            digest: 可选，已知的 image_bgr 像素哈希（如 ImageHandle.digest），作为中间层缓存的键；
+                    None 时本次调用计算一次
         Returns:
             美化后的BGR图像
         """
+        if not (whitening > 0 or smoothing > 0 or bright_eyes > 0 or red_lips > 0):
+            return image_bgr.copy()
+        # 中间结果的内容由源图和已应用的效果决定，缓存键沿处理流程推导
+        key = (digest or pixel_digest(image_bgr),)
+        
+        # 结果图只复制一次，之后的效果原地写入各自的遮罩区域（美白整图转换，返回新图）
         result_image = image_bgr.copy()
         
-        for face_data in faces_data:
+        for index, face_data in enumerate(faces_data):
             # 美白处理
             if whitening > 0:
-                result_image = self._apply_whitening(result_image, face_data, whitening)
+                result_image = self._apply_whitening(result_image, face_data, whitening, key)
+                key += (('whitening', index, whitening),)
             
             # 磨皮处理
             if smoothing > 0:
-                result_image = self._apply_smoothing(result_image, face_data, smoothing)
+                result_image = self._apply_smoothing(result_image, face_data, smoothing, detail_scale, key)
+                key += (('smoothing', index, smoothing, detail_scale),)
             
             # 亮眼处理
             if bright_eyes > 0:
                 result_image = self._apply_bright_eyes(result_image, face_data, bright_eyes)
+                key += (('bright_eyes', index, bright_eyes),)
             
             # 红唇处理
             if red_lips > 0:
                 result_image = self._apply_red_lips(result_image, face_data, red_lips)
+                key += (('red_lips', index, red_lips),)
         
         return result_image
     
-    def _apply_whitening(self, image_bgr: np.ndarray, face_data: Dict, intensity: float) -> np.ndarray:
-        """应用美白效果 - 修复额头和眉毛之间的黑线问题"""
-        intensity = intensity / 100.0
+    def _layer(self, name: str, key: Tuple, image: np.ndarray, compute, *params) -> np.ndarray:
+        """
+        获取与强度无关的中间层（按输入内容键和参数缓存）
+        同一输入只计算一次，之后调节强度时只需在遮罩区域内混合
+        key: 标识 image 像素内容的键，(源图像素哈希, 已应用的效果..., [子图矩形])，
+             由调用方保证相同的键对应相同的输入，查找时不再对输入计算哈希
+        """
+        key = (name, key, params)
+        layer = self._layer_cache.get(key)
+        if layer is not None:
+            self._layer_cache.move_to_end(key)
+            return layer
         
-        # 转换为HSV空间进行美白处理
-        image_hsv = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2HSV)
+        layer = compute(image, *params)
+        self._layer_cache[key] = layer
+        # 超出内存预算时淘汰最久未使用的中间层
+        while len(self._layer_cache) > 1 and self.cache_nbytes() > self.max_cache_bytes:
+            self._layer_cache.popitem(last=False)
+        return layer
+    
+    def cache_nbytes(self) -> int:
+        """中间层缓存占用的字节数"""
+        return sum(layer.nbytes for layer in self._layer_cache.values())
+    
+    def clear_cache(self):
+        """清空中间层缓存（更换图片或人脸数据时调用）"""
+        self._layer_cache.clear()
+    
+    def invalidate_cache(self, digest: str):
+        """使由像素哈希为 digest 的源图派生的中间层失效（源图被原地修改、哈希不再可信时调用）"""
+        for key in [key for key in self._layer_cache if key[1][0] == digest]:
+            del self._layer_cache[key]
+    
+    def _roi_key(self, roi: Tuple[slice, slice]) -> Tuple:
+        """矩形在缓存键中的表示（slice 不可哈希）"""
+        return (roi[0].start, roi[0].stop, roi[1].start, roi[1].stop)
+    
+    def _hsv_to_bgr(self, image_hsv: np.ndarray, roi: Optional[Tuple[slice, slice]],
+                    v_channel: Optional[np.ndarray]) -> np.ndarray:
+        """
+        把 roi 内 V 通道替换为 v_channel 后的 HSV 图转回 BGR
+        image_hsv 为缓存的中间层：临时写入 roi 再恢复，不复制整图
+        HSV 转回 BGR 需要整图转换（OpenCV 对子图和整图的舍入不完全一致）
+        """
+        if roi is None:
+            return cv2.cvtColor(image_hsv, cv2.COLOR_HSV2BGR)
+        v_view = image_hsv[roi][:, :, 2]
+        saved = v_view.copy()
+        v_view[...] = v_channel
+        try:
+            return cv2.cvtColor(image_hsv, cv2.COLOR_HSV2BGR)
+        finally:
+            v_view[...] = saved
+    
+    def _pad_roi(self, roi: Tuple[slice, slice], pad: int, shape: Tuple[int, ...]) -> Tuple[slice, slice]:
+        """矩形向外扩展 pad 像素（裁剪到图像范围内）"""
+        return (slice(max(roi[0].start - pad, 0), min(roi[0].stop + pad, shape[0])),
+                slice(max(roi[1].start - pad, 0), min(roi[1].stop + pad, shape[1])))
+    
+    def _smoothing_diameter(self, detail_scale: float) -> int:
+        """双边滤波窗口（原图为 9），缩小的图像上按比例缩小，保持奇数且不小于 3"""
+        return 9 if detail_scale >= 1.0 else max(3, int(round(9 * detail_scale)) | 1)
+    
+    def _whitening_mask(self, face_data: Dict) -> MaskTile:
+        """美白区域遮罩：脸部 + 额头 + 向外扩展的眉毛区域"""
+        organs_masks = face_data['organs_masks']
+        shape = organs_masks['face'].shape
+        parts = [organs_masks['face']]
+        
+        # 获取额头遮罩（单独处理）
+        if 'forehead' in organs_masks:
+            parts.append(organs_masks['forehead'])
+        brows = []
+        if 'left_brow' in organs_masks and 'right_brow' in organs_masks:
+            brows = [organs_masks['left_brow'], organs_masks['right_brow']]
+        
+        # 眉毛膨胀 2 像素，外接矩形相应扩大
+        rois = [mask.roi for mask in parts if mask.roi is not None]
+        rois += [self._pad_roi(mask.roi, 2, shape) for mask in brows if mask.roi is not None]
+        if not rois:
+            return MaskTile(np.zeros((0, 0), dtype=np.uint8), (0, 0), shape)
+        roi = (slice(min(r[0].start for r in rois), max(r[0].stop for r in rois)),
+               slice(min(r[1].start for r in rois), max(r[1].stop for r in rois)))
+        
+        # 创建联合遮罩（脸部+额头）
+        mask_combined = np.zeros((roi[0].stop - roi[0].start, roi[1].stop - roi[1].start), dtype=np.uint8)
+        for mask in parts:
+            self._max_into(mask_combined, roi, mask)
+        
+        # 特别处理额头和眉毛交界处（修复黑线问题）
+        if brows:
+            mask_brows = np.zeros_like(mask_combined)
+            for mask in brows:
+                self._max_into(mask_brows, roi, mask)
+            
+            # 在眉毛上方扩展5像素的区域
+            kernel = np.ones((5, 5), np.uint8)
+            mask_brows_extended = cv2.dilate(mask_brows, kernel, iterations=1)
+            
+            # 将这些区域加入美白区域
+            mask_combined = np.maximum(mask_combined, mask_brows_extended)
+        
+        return MaskTile(mask_combined, (roi[0].start, roi[1].start), shape)
+    
+    def _max_into(self, canvas: np.ndarray, roi: Tuple[slice, slice], mask: MaskTile):
+        """把遮罩按最大值合并到覆盖原图矩形 roi 的画布上"""
+        overlap = mask.overlap(roi)
+        if overlap is not None:
+            np.maximum(canvas[overlap[0]], overlap[1], out=canvas[overlap[0]])
+    
+    def _apply_whitening(self, image_bgr: np.ndarray, face_data: Dict, intensity: float, key: Tuple) -> np.ndarray:
+        """应用美白效果 - 修复额头和眉毛之间的黑线问题（key: image_bgr 的内容键，见 _layer）"""
+        intensity = intensity / 100.0
         
         # 获取脸部遮罩（包含额头）
         if 'face' in face_data['organs_masks']:
-            mask_face = face_data['organs_masks']['face']
+            # 转换为HSV空间进行美白处理（HSV图与强度无关，缓存复用）
+            image_hsv = self._layer('hsv', key, image_bgr, cv2.cvtColor, cv2.COLOR_BGR2HSV)
             
-            # 获取额头遮罩（单独处理）
-            mask_forehead = face_data['organs_masks'].get('forehead', np.zeros_like(mask_face))
+            # 获取脸部遮罩（包含额头和眉毛）
+            mask_combined = self._whitening_mask(face_data)
             
-            # 创建联合遮罩（脸部+额头）
-            mask_combined = np.maximum(mask_face, mask_forehead)
-            
-            # 特别处理额头和眉毛交界处（修复黑线问题）
-            if 'left_brow' in face_data['organs_masks'] and 'right_brow' in face_data['organs_masks']:
-                mask_brows = np.maximum(
-                    face_data['organs_masks']['left_brow'],
-                    face_data['organs_masks']['right_brow']
-                )
+            # 遮罩之外亮度不变，只在遮罩外接矩形内计算新的V通道
+            roi = mask_combined.roi
+            v_new = None
+            if roi is not None:
+                # 参考标准实现：在HSV空间调整V通道
+                v_channel = image_hsv[roi][:, :, 2].astype(np.float32)
                 
-                # 在眉毛上方扩展5像素的区域
-                kernel = np.ones((5, 5), np.uint8)
-                mask_brows_extended = cv2.dilate(mask_brows, kernel, iterations=1)
+                # 创建美白遮罩（更柔和的处理）
+                whitening_mask = (mask_combined.tile / 255.0 * intensity).astype(np.float32)
                 
-                # 将这些区域加入美白区域
-                mask_combined = np.maximum(mask_combined, mask_brows_extended)
-            
-            # 参考标准实现：在HSV空间调整V通道
-            v_channel = image_hsv[:, :, 2].astype(np.float32)
-            
-            # 创建美白遮罩（更柔和的处理）
-            whitening_mask = (mask_combined / 255.0 * intensity).astype(np.float32)
-            
-            # 应用美白：提高亮度，但保持自然过渡
-            v_whitened = np.minimum(v_channel + v_channel * whitening_mask * 0.3, 255)
+                # 应用美白：提高亮度，但保持自然过渡
+                v_whitened = np.minimum(v_channel + v_channel * whitening_mask * 0.3, 255)
+                
+                # 根据遮罩混合原图和美白后的图像
+                v_blended = v_channel * (1 - whitening_mask) + v_whitened * whitening_mask
+                v_new = np.clip(v_blended, 0, 255).astype(np.uint8)
             
-            # 根据遮罩混合原图和美白后的图像
-            v_blended = v_channel * (1 - whitening_mask) + v_whitened * whitening_mask
-            image_hsv[:, :, 2] = np.clip(v_blended, 0, 255).astype(np.uint8)
+            return self._hsv_to_bgr(image_hsv, roi, v_new)
         
-        return cv2.cvtColor(image_hsv, cv2.COLOR_HSV2BGR)
+        return cv2.cvtColor(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2HSV), cv2.COLOR_HSV2BGR)
     
-    def _apply_smoothing(self, image_bgr: np.ndarray, face_data: Dict, intensity: float) -> np.ndarray:
-        """应用磨皮效果"""
+    def _apply_smoothing(self, image_bgr: np.ndarray, face_data: Dict, intensity: float,
+                         detail_scale: float, key: Tuple) -> np.ndarray:
+        """应用磨皮效果，结果原地写入 image_bgr（key: image_bgr 的内容键，见 _layer）"""
         intensity = intensity / 100.0
+        diameter = self._smoothing_diameter(detail_scale)
         
         for organ_name in ['face', 'forehead']:
             if organ_name in face_data['organs_masks']:
                 mask = face_data['organs_masks'][organ_name]
-                # 双边滤波磨皮
-                smoothed = cv2.bilateralFilter(image_bgr, 9, 75, 75)
+                # 只在遮罩外接矩形内混合，双边滤波的输入向外多取一个滤波半径，结果与整图滤波一致
+                roi = mask.roi
+                if roi is None:
+                    continue
+                tile_roi = self._pad_roi(roi, diameter // 2, image_bgr.shape)
+                tile = image_bgr[tile_roi]
+                # 双边滤波磨皮（与强度无关，按输入内容缓存）
+                smoothed_tile = self._layer('bilateral', key + (self._roi_key(tile_roi),), tile,
+                                            cv2.bilateralFilter, diameter, 75, 75)
+                inner = (slice(roi[0].start - tile_roi[0].start, roi[0].stop - tile_roi[0].start),
+                         slice(roi[1].start - tile_roi[1].start, roi[1].stop - tile_roi[1].start))
+                smoothed = smoothed_tile[inner]
                 # 根据遮罩混合
-                blend_mask = (mask / 255.0 * intensity).astype(np.float32)
-                result = image_bgr.astype(np.float32) * (1 - blend_mask[..., None]) + \
+                blend_mask = (mask.tile / 255.0 * intensity).astype(np.float32)
+                result = image_bgr[roi].astype(np.float32) * (1 - blend_mask[..., None]) + \
                         smoothed.astype(np.float32) * blend_mask[..., None]
-                image_bgr = np.clip(result, 0, 255).astype(np.uint8)
+                image_bgr[roi] = np.clip(result, 0, 255).astype(np.uint8)
+                key += (('smoothing', organ_name, intensity),)
         
         return image_bgr
     
     def _apply_bright_eyes(self, image_bgr: np.ndarray, face_data: Dict, intensity: float) -> np.ndarray:
-        """应用亮眼效果"""
+        """应用亮眼效果，结果原地写入 image_bgr"""
         intensity = intensity / 100.0
         
         for eye_name in ['left_eye', 'right_eye']:
             if eye_name in face_data['organs_masks']:
                 mask = face_data['organs_masks'][eye_name]
+                # 只处理眼睛遮罩的外接矩形
+                roi = mask.roi
+                if roi is None:
+                    continue
                 # 提高眼睛区域对比度
-                eye_region = image_bgr.copy()
-                eye_region = cv2.convertScaleAbs(eye_region, alpha=1.0 + intensity * 0.3, beta=10 * intensity)
+                eye_region = cv2.convertScaleAbs(image_bgr[roi], alpha=1.0 + intensity * 0.3, beta=10 * intensity)
                 # 根据遮罩混合
-                blend_mask = (mask / 255.0 * intensity).astype(np.float32)
-                result = image_bgr.astype(np.float32) * (1 - blend_mask[..., None]) + \
+                blend_mask = (mask.tile / 255.0 * intensity).astype(np.float32)
+                result = image_bgr[roi].astype(np.float32) * (1 - blend_mask[..., None]) + \
                         eye_region.astype(np.float32) * blend_mask[..., None]
-                image_bgr = np.clip(result, 0, 255).astype(np.uint8)
+                image_bgr[roi] = np.clip(result, 0, 255).astype(np.uint8)
         
         return image_bgr
     
     def _apply_red_lips(self, image_bgr: np.ndarray, face_data: Dict, intensity: float) -> np.ndarray:
-        """应用红唇效果"""
+        """应用红唇效果，结果原地写入 image_bgr"""
         intensity = intensity / 100.0
         
         if 'mouth' in face_data['organs_masks']:
             mask = face_data['organs_masks']['mouth']
-            # 增强红色通道
-            b, g, r = cv2.split(image_bgr.astype(np.float32))
+            roi = mask.roi
+            if roi is None:
+                return image_bgr
+            # 增强红色通道（只处理嘴唇遮罩的外接矩形）
+            r = image_bgr[roi][:, :, 2].astype(np.float32)
             r_enhanced = np.minimum(r * (1 + intensity * 0.5), 255)
             # 根据遮罩混合
-            blend_mask = (mask / 255.0 * intensity).astype(np.float32)
+            blend_mask = (mask.tile / 255.0 * intensity).astype(np.float32)
             r_blended = r * (1 - blend_mask) + r_enhanced * blend_mask
-            image_bgr = cv2.merge([b, g, r_blended]).astype(np.uint8)
+            image_bgr[roi][:, :, 2] = r_blended.astype(np.uint8)
         
         return image_bgr
\ No newline at end of file
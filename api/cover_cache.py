@@ -0,0 +1,105 @@
+"""
+封面结果缓存 - 按内容寻址的持久化封面缓存
+
+缓存键由用户图片内容哈希、模板标识（路径、mtime、大小）和封面算法版本组成，
+相同照片再次选择同一歌手时直接返回已生成的封面。
+缓存目录有字节预算，超出时按最近使用时间（文件 mtime）淘汰，写入通过临时文件 + 替换保证原子性。
+"""
+import os
+import hashlib
+import threading
+
+COVER_CACHE_DIR = "temp/cover_cache"
+COVER_CACHE_MAX_BYTES = 200 * 1024 * 1024  # 200 MB
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def file_digest(path):
+    """计算文件内容的 sha1，文件不存在或无法读取时返回 None"""
+    try:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+    except (OSError, TypeError):
+        return None
+
+class CoverCache:
+    """按内容寻址、有字节预算的封面缓存"""
+    def __init__(self, cache_dir=COVER_CACHE_DIR, max_bytes=COVER_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def make_key(self, image_digest, template_path, algorithm_version):
+        """由图片内容哈希、模板标识和算法版本计算缓存键"""
+        try:
+            st = os.stat(template_path)
+            template_id = f"{template_path}|{st.st_mtime_ns}|{st.st_size}"
+        except OSError:
+            template_id = f"{template_path}|missing"
+        key_source = f"{algorithm_version}|{image_digest}|{template_id}"
+        return hashlib.sha1(key_source.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.jpg")
+
+    def get(self, key):
+        """命中时返回封面路径并刷新其最近使用时间，未命中返回 None"""
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def temp_path(self, key):
+        """返回写入新封面用的临时路径（保留 .jpg 扩展名以便 cv2.imwrite 识别格式）"""
+        return os.path.join(self.cache_dir, f"{key}.{os.getpid()}.{threading.get_ident()}.tmp.jpg")
+
+    def store(self, key, temp_path):
+        """把写好的临时文件原子地放入缓存，返回最终路径"""
+        path = self._path(key)
+        os.replace(temp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """淘汰最久未使用的封面，直到总大小不超过预算（keep 指定的文件不会被淘汰）"""
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".jpg") or name.endswith(".tmp.jpg"):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if keep and os.path.abspath(path) == os.path.abspath(keep):
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+def get_cover_cache():
+    """获取进程内共享的默认封面缓存"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = CoverCache()
+    return _default_cache
\ No newline at end of file
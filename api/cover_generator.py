@@ -2,21 +2,35 @@
 封面生成API调用 - 适配歌手主题
 """
 import os
+import shutil
+import threading
+import multiprocessing
 import cv2
-import dlib
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from templates.theme_shows import get_theme_show
+from api.face_models import get_detector, get_predictor
+from api.landmark_store import get_landmark_store, pixel_digest
+from api.cover_cache import get_cover_cache, file_digest
+
+# 封面算法版本，修改 face_change 的输出效果时需要递增，使旧的缓存封面失效
+COVER_ALGORITHM_VERSION = 4
+# get_face_mask 两次羽化（核大小 11）会让遮罩向外扩散约 10 像素，遮罩只在特征点外接矩形外扩该距离内非零
+FACE_MASK_PAD = 2 * 11 + 2
+# 并发生成时等待任务完成的同时检查取消的间隔（秒）
+COVER_CANCEL_POLL_INTERVAL = 0.1
 
 
 def get_landmarks(im, detector, predictor):
     """返回 dlib landmarks（numpy.matrix，shape (68,2)），若未检测到或检测到多个脸会抛异常"""
-    rects = detector(im, 1)
-    # if len(rects) > 1:
+    # 按像素内容查表，同一张图片只检测一次
+    faces = get_landmark_store().find_landmarks(im, detector, predictor)
+    # if len(faces) > 1:
     #     print("检测到多张人脸，无法处理")
-    # if len(rects) == 0:
+    # if len(faces) == 0:
     #     print("未检测到人脸，无法处理")
-    return np.matrix([[p.x, p.y] for p in predictor(im, rects[0]).parts()])
+    return np.matrix(faces[0])
 
 def transformation_from_points(points1, points2):
     """
@@ -51,10 +65,12 @@ def draw_convex_hull(im, points, color):
     points = cv2.convexHull(points)
     cv2.fillConvexPoly(im, points, color=color)
 
-def get_face_mask(im, landmarks):
+def get_face_mask(im, landmarks, channels=3, dtype=np.float64):
     """
-    返回与 im 相同宽高的三通道 float mask，取值大致在 [0,1]
+    返回与 im 相同宽高的 float mask，取值大致在 [0,1]
     landmarks: numpy.matrix (68,2)
+    channels: 3 返回三通道 mask，1 返回单通道 mask（各通道本来就相同）
+    dtype: mask 的浮点类型（羽化阈值对精度敏感，与原算法一致时使用默认的 np.float64）
     """
 
     feather_amount = 11
@@ -85,13 +101,14 @@ def get_face_mask(im, landmarks):
         mouth_points,
     ]
 
-    im_mask = np.zeros(im.shape[:2], dtype=np.float64)
+    im_mask = np.zeros(im.shape[:2], dtype=dtype)
     for group in overlay_points:
         draw_convex_hull(im_mask, np.array(landmarks[group], dtype=np.int32), color=1)
-    im_mask = np.array([im_mask, im_mask, im_mask]).transpose((1, 2, 0))
+    if channels == 3:
+        im_mask = np.array([im_mask, im_mask, im_mask]).transpose((1, 2, 0))
     # feather / blur
     feather = feather_amount if feather_amount % 2 == 1 else feather_amount + 1
-    im_mask = (cv2.GaussianBlur(im_mask, (feather, feather), 0) > 0) * 1.0
+    im_mask = (cv2.GaussianBlur(im_mask, (feather, feather), 0) > 0).astype(dtype)
     im_mask = cv2.GaussianBlur(im_mask, (feather, feather), 0)
     return im_mask
 
@@ -108,12 +125,29 @@ def warp_im(im, M, dshape):
                    flags=cv2.WARP_INVERSE_MAP)
     return output_im
 
-def correct_colours(im1, im2, landmarks1):
+def points_bbox(points, pad, shape):
     """
-    颜色校正：把 im2 的颜色校正到 im1（使用 landmarks1 计算模糊尺度）
-    返回 float64 图像
+    返回点集外接矩形向外扩展 pad 像素并裁剪到图像范围后的 (x0, y0, x1, y1)，右/下边界不含
     """
-    
+    points = np.asarray(points, dtype=np.float64)
+    x0 = max(int(np.floor(points[:, 0].min())) - pad, 0)
+    y0 = max(int(np.floor(points[:, 1].min())) - pad, 0)
+    x1 = min(int(np.ceil(points[:, 0].max())) + pad + 1, shape[1])
+    y1 = min(int(np.ceil(points[:, 1].max())) + pad + 1, shape[0])
+    return x0, y0, x1, y1
+
+def shift_affine(M, dst_offset=(0, 0), src_offset=(0, 0)):
+    """
+    把 warp_im 使用的仿射矩阵改写为在子图上使用：
+    dst_offset 为输出子图在目标图中的左上角，src_offset 为输入子图在源图中的左上角
+    返回 2x3 ndarray
+    """
+    M2 = np.array(M[:2], dtype=np.float64)
+    M2[:, 2] += M2[:, :2] @ np.array(dst_offset, dtype=np.float64) - np.array(src_offset, dtype=np.float64)
+    return M2
+
+def colour_correct_blur_amount(landmarks1):
+    """根据两眼间距计算颜色校正使用的高斯核大小（奇数）"""
     colour_correct_blur_frac = 0.6
 
     # landmark 索引定义
@@ -134,8 +168,18 @@ def correct_colours(im1, im2, landmarks1):
         blur_amount += 1
     # 防止 blur_amount 太小
     blur_amount = max(1, blur_amount)
+    return blur_amount
 
-    im1_blur = cv2.GaussianBlur(im1, (blur_amount, blur_amount), 0)
+def correct_colours(im1, im2, landmarks1, im1_blur=None):
+    """
+    颜色校正：把 im2 的颜色校正到 im1（使用 landmarks1 计算模糊尺度）
+    im1_blur: 可选，预先计算好的 im1 模糊图（来自模板索引）
+    返回 float64 图像
+    """
+    blur_amount = colour_correct_blur_amount(landmarks1)
+
+    if im1_blur is None:
+        im1_blur = cv2.GaussianBlur(im1, (blur_amount, blur_amount), 0)
     im2_blur = cv2.GaussianBlur(im2, (blur_amount, blur_amount), 0)
 
     # 避免除零
@@ -145,10 +189,166 @@ def correct_colours(im1, im2, landmarks1):
     return (im2.astype(np.float64) * im1_blur.astype(np.float64) /
             im2_blur.astype(np.float64))
 
-def face_change(template_path, user_path, output_path, detector, predictor):
-    """人脸替换函数"""
+def prepare_template(im1, detector, predictor):
+    """
+    计算模板侧只依赖模板图片本身的数据，可离线缓存到模板索引中
+    遮罩和模糊图只保存脸部附近的子图（内存与人脸大小相关，与模板分辨率无关）
+    返回 dict:
+        landmarks (numpy.matrix (68,2))
+        mask / mask_offset: 单通道 float64 遮罩子图及其左上角 (x, y)，子图之外遮罩为 0
+        blur / blur_offset: 颜色校正用的模糊图子图及其左上角 (x, y)，之外的部分由 template_blur_tile 现算
+    """
+    landmarks1 = get_landmarks(im1, detector, predictor)
+    # 遮罩只在特征点外接矩形外扩 FACE_MASK_PAD 内非零，在该子图上生成（结果与整图生成相同）
+    mx0, my0, mx1, my1 = points_bbox(landmarks1, FACE_MASK_PAD, im1.shape)
+    # 保持 float64：降低精度会使默认（float64）合成模式的少量像素相差 1 级
+    mask1 = get_face_mask(im1[my0:my1, mx0:mx1], landmarks1 - [mx0, my0], channels=1)
+
+    # 模糊图覆盖遮罩范围再向外扩展半个脸宽，容纳对齐后用户遮罩超出模板遮罩的部分
+    margin = max(mx1 - mx0, my1 - my0) // 2
+    blur_roi = (max(mx0 - margin, 0), max(my0 - margin, 0),
+                min(mx1 + margin, im1.shape[1]), min(my1 + margin, im1.shape[0]))
+    return {
+        "landmarks": landmarks1,
+        "mask": mask1,
+        "mask_offset": (mx0, my0),
+        "blur": _blur_roi(im1, landmarks1, blur_roi),
+        "blur_offset": blur_roi[:2],
+    }
+
+def _blur_roi(im1, landmarks1, roi):
+    """在 roi (x0, y0, x1, y1) 外扩模糊核半径的子图上计算颜色校正模糊图，结果与整图模糊后裁剪相同"""
+    x0, y0, x1, y1 = roi
+    blur_amount = colour_correct_blur_amount(landmarks1)
+    pad = blur_amount // 2 + 1
+    px0, py0 = max(x0 - pad, 0), max(y0 - pad, 0)
+    px1, py1 = min(x1 + pad, im1.shape[1]), min(y1 + pad, im1.shape[0])
+    blurred = cv2.GaussianBlur(im1[py0:py1, px0:px1], (blur_amount, blur_amount), 0)
+    return blurred[y0 - py0:y1 - py0, x0 - px0:x1 - px0].copy()
+
+def template_mask_tile(template_data, roi):
+    """模板遮罩在 roi (x0, y0, x1, y1) 内的单通道 float64 子图"""
+    x0, y0, x1, y1 = roi
+    tile = np.zeros((y1 - y0, x1 - x0), dtype=np.float64)
+    mask = template_data["mask"]
+    mx, my = template_data["mask_offset"]
+    ix0, iy0 = max(x0, mx), max(y0, my)
+    ix1, iy1 = min(x1, mx + mask.shape[1]), min(y1, my + mask.shape[0])
+    if ix1 > ix0 and iy1 > iy0:
+        tile[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = mask[iy0 - my:iy1 - my, ix0 - mx:ix1 - mx]
+    return tile
+
+def template_blur_tile(template_data, im1, roi):
+    """颜色校正模糊图在 roi (x0, y0, x1, y1) 内的子图：在保存的范围内直接切片，否则从模板图像现算"""
+    x0, y0, x1, y1 = roi
+    blur = template_data["blur"]
+    bx, by = template_data["blur_offset"]
+    if x0 >= bx and y0 >= by and x1 <= bx + blur.shape[1] and y1 <= by + blur.shape[0]:
+        return blur[y0 - by:y1 - by, x0 - bx:x1 - bx]
+    return _blur_roi(im1, template_data["landmarks"], roi)
+
+# 低内存合成模式使用的线程内工作缓冲区: name -> 一维数组（按需增大，重复使用）
+_work_buffers = threading.local()
+
+def _work_buffer(name, shape, dtype):
+    """返回当前线程可复用的工作缓冲区视图，内容未初始化"""
+    pool = getattr(_work_buffers, "pool", None)
+    if pool is None:
+        pool = _work_buffers.pool = {}
+    size = int(np.prod(shape))
+    buffer = pool.get(name)
+    if buffer is None or buffer.dtype != dtype or buffer.size < size:
+        buffer = np.empty(size, dtype=dtype)
+        pool[name] = buffer
+    return buffer[:size].reshape(shape)
+
+def composite_tile_lowmem(out_tile, im1_tile, mask1_tile, im1_blur_tile, mask2, M_mask,
+                          im2, M_im, landmarks1, mode="float32"):
+    """
+    低内存的子图合成：单通道 alpha、就地运算、复用工作缓冲区，结果直接写入 out_tile
+    mask2: get_face_mask(..., channels=1) 生成的用户侧单通道 mask（与原算法相同的 float64 精度）
+    mode: "float32" 用 float32 做颜色校正和混合；"uint8" 用 8 位定点 alpha 和 32 位整数混合
+    两种模式都混合未裁剪的颜色校正结果，混合后才裁剪到 0~255（与原算法相同）
+    返回本次使用的工作缓冲区字节数
+    """
+    h, w = im1_tile.shape[:2]
+
+    # 单通道 alpha = max(模板 mask, warp 后的用户 mask)，按原算法的 float64 精度 warp
+    # alpha 保持 float64：cv2.warpAffine 对 float32 输入的插值与 float64 不同，遮罩边缘相差可达 0.09，
+    # 颜色校正放大后个别像素相差 10 级以上；先以 float64 warp 再转 float32 又需要同样大小的 float64 缓冲区。
+    # 单通道 float64 仍只有原算法三通道 float64 mask 的 1/3
+    alpha = _work_buffer("alpha", (h, w), np.float64)
+    alpha.fill(0)
+    cv2.warpAffine(mask2, M_mask, (w, h), dst=alpha,
+                   borderMode=cv2.BORDER_TRANSPARENT, flags=cv2.WARP_INVERSE_MAP)
+    np.maximum(alpha, mask1_tile, out=alpha)
+
+    # warp 用户图像
+    warped = _work_buffer("warped", (h, w, 3), np.uint8)
+    warped.fill(0)
+    cv2.warpAffine(im2, M_im, (w, h), dst=warped,
+                   borderMode=cv2.BORDER_TRANSPARENT, flags=cv2.WARP_INVERSE_MAP)
+
+    # 颜色校正：warped * im1_blur / warped_blur（避免除零）
+    blur_amount = colour_correct_blur_amount(landmarks1)
+    warped_blur = _work_buffer("warped_blur", (h, w, 3), np.uint8)
+    cv2.GaussianBlur(warped, (blur_amount, blur_amount), 0, dst=warped_blur)
+    denominator = _work_buffer("denominator", (h, w, 3), np.float32)
+    denominator[:] = warped_blur
+    np.add(denominator, 128, out=denominator, where=denominator <= 1.0)
+    corrected = _work_buffer("corrected", (h, w, 3), np.float32)
+    corrected[:] = warped
+    corrected *= im1_blur_tile
+    corrected /= denominator
+
+    used_bytes = alpha.nbytes + warped.nbytes + warped_blur.nbytes + denominator.nbytes + corrected.nbytes
+
+    if mode == "uint8":
+        # 8 位定点 alpha：out = (corrected * a + im1 * (255 - a)) // 255
+        # 颜色校正结果可能超过 255，取整后保留在 int32 中参与混合，混合后再裁剪
+        alpha *= 255
+        alpha_u8 = _work_buffer("alpha_u8", (h, w), np.uint8)
+        np.rint(alpha, out=alpha)
+        alpha_u8[:] = alpha
+        # 两个 int32 中间结果复用已经不再需要的 float32 缓冲区（字节数相同）
+        accumulator = denominator.view(np.int32)
+        np.rint(corrected, out=corrected)
+        accumulator[:] = corrected
+        accumulator *= alpha_u8[:, :, np.newaxis]
+        np.subtract(255, alpha_u8, out=alpha_u8)
+        term = corrected.view(np.int32)
+        np.multiply(im1_tile, alpha_u8[:, :, np.newaxis], out=term, dtype=np.int32)
+        accumulator += term
+        accumulator //= 255
+        np.clip(accumulator, 0, 255, out=accumulator)
+        out_tile[:] = accumulator
+        used_bytes += alpha_u8.nbytes
+    else:
+        # 就地计算 im1 + alpha * (corrected - im1)，等价于 im1 * (1 - alpha) + corrected * alpha
+        corrected -= im1_tile
+        corrected *= alpha[:, :, np.newaxis]
+        corrected += im1_tile
+        np.clip(corrected, 0, 255, out=corrected)
+        out_tile[:] = corrected
+
+    return used_bytes
+
+def face_change(template_path, user_path, output_path, detector, predictor, template_data=None,
+                composite_mode="float64", stats=None, user_image=None, user_landmarks=None, cancel_event=None):
+    """
+    人脸替换函数
+    user_image: 可选，已解码的用户 BGR 图像，提供时不再读取 user_path（user_path 可为 None）
+    user_landmarks: 可选，user_image 上已知的68点特征点，提供时跳过用户侧的人脸检测
+    template_data: 可选，prepare_template 的结果（来自模板索引），提供时跳过模板侧的检测和遮罩计算
+    composite_mode: 合成精度，"float64"（原始实现）、"float32" 或 "uint8"（低内存模式，见 composite_tile_lowmem）
+    stats: 可选 dict，写入本次合成的峰值内存估计 peak_bytes（同时存活的图像和工作缓冲区字节数）
+    cancel_event: 可选，被设置时在下一个阶段（特征点、warp、颜色校正、融合）开始前停止，不写出结果并返回 None
+    """
     scale_factor = 1
 
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
     # landmark 索引定义
     face_points = list(range(17, 68))
     mouth_points = list(range(48, 61))
@@ -176,171 +376,385 @@ def face_change(template_path, user_path, output_path, detector, predictor):
     )
 
     tpl_p = Path(template_path)
-    user_p = Path(user_path)
     out_p = Path(output_path)
 
     im1 = cv2.imread(str(tpl_p), cv2.IMREAD_COLOR)
-    im2 = cv2.imread(str(user_p), cv2.IMREAD_COLOR)
+    if user_image is not None:
+        im2 = user_image
+    else:
+        im2 = cv2.imread(str(Path(user_path)), cv2.IMREAD_COLOR)
 
     if scale_factor != 1:
         im1 = cv2.resize(im1, (int(im1.shape[1] * scale_factor), int(im1.shape[0] * scale_factor)))
         im2 = cv2.resize(im2, (int(im2.shape[1] * scale_factor), int(im2.shape[0] * scale_factor)))
 
-    landmarks1 = get_landmarks(im1, detector, predictor)
-    landmarks2 = get_landmarks(im2, detector, predictor)
+    if cancelled():
+        return None
+    if template_data is None:
+        template_data = prepare_template(im1, detector, predictor)
+    landmarks1 = template_data["landmarks"]
+    if user_landmarks is not None:
+        landmarks2 = np.matrix((np.asarray(user_landmarks) * scale_factor).astype(np.int64))
+    else:
+        landmarks2 = get_landmarks(im2, detector, predictor)
+    if cancelled():
+        return None
 
     # 计算仿射矩阵：把 user 对齐到 template
     M = transformation_from_points(landmarks1[align_points], landmarks2[align_points])
 
-    # 生成 mask 并 warp 回 template 尺寸
-    mask2 = get_face_mask(im2, landmarks2)
-    warped_mask = warp_im(mask2, M, im1.shape)
-    mask1 = get_face_mask(im1, landmarks1)
-    combined_mask = np.max([mask1, warped_mask], axis=0)
-
-    # warp user 图像并进行颜色校正
-    warped_im2 = warp_im(im2, M, im1.shape)
-    warped_corrected_im2 = correct_colours(im1, warped_im2, landmarks1)
-
-    # 融合（按 mask 权重混合）
-    output_im = im1 * (1.0 - combined_mask) + warped_corrected_im2 * combined_mask
-
-    # 保存前把像素裁剪回 0-255 并转 uint8
-    output_im = np.clip(output_im, 0, 255).astype(np.uint8)
+    # 只在脸部附近的子图上合成：遮罩之外输出就是模板本身，代价只与人脸大小有关
+    mask_pad = FACE_MASK_PAD
+
+    # 用户侧：只在用户人脸外接矩形内生成 mask（低内存模式下为单通道）
+    # mask 的羽化阈值对精度敏感，两种模式都按原算法的 float64 生成，否则遮罩边缘会相差一个像素
+    lowmem = composite_mode in ("float32", "uint8")
+    ux0, uy0, ux1, uy1 = points_bbox(landmarks2, mask_pad, im2.shape)
+    if lowmem:
+        mask2 = get_face_mask(im2[uy0:uy1, ux0:ux1], landmarks2 - [ux0, uy0], channels=1)
+    else:
+        mask2 = get_face_mask(im2[uy0:uy1, ux0:ux1], landmarks2 - [ux0, uy0])
+
+    # 模板侧：模板遮罩范围与用户遮罩映射到模板后的范围取并集
+    user_corners = np.array([[ux0, uy0, 1], [ux1, uy0, 1], [ux0, uy1, 1], [ux1, uy1, 1]], dtype=np.float64)
+    warped_corners = (np.linalg.inv(np.asarray(M)) @ user_corners.T).T[:, :2]
+    x0, y0, x1, y1 = points_bbox(np.vstack([np.asarray(landmarks1), warped_corners]), mask_pad, im1.shape)
+
+    output_im = im1.copy()
+    peak_bytes = im1.nbytes + im2.nbytes + output_im.nbytes + mask2.nbytes
+    if x1 > x0 and y1 > y0:
+        # 颜色校正的高斯模糊需要 ROI 外 blur_amount // 2 的邻域
+        blur_pad = colour_correct_blur_amount(landmarks1) // 2 + 1
+        wx0, wy0 = max(x0 - blur_pad, 0), max(y0 - blur_pad, 0)
+        wx1, wy1 = min(x1 + blur_pad, im1.shape[1]), min(y1 + blur_pad, im1.shape[0])
+        tile_shape = (wy1 - wy0, wx1 - wx0, im1.shape[2])
+        im1_tile = im1[wy0:wy1, wx0:wx1]
+        mask1_tile = template_mask_tile(template_data, (wx0, wy0, wx1, wy1))
+        im1_blur_tile = template_blur_tile(template_data, im1, (wx0, wy0, wx1, wy1))
+        if cancelled():
+            return None
+
+        if lowmem:
+            peak_bytes += composite_tile_lowmem(
+                output_im[wy0:wy1, wx0:wx1], im1_tile, mask1_tile, im1_blur_tile,
+                mask2, shift_affine(M, (wx0, wy0), (ux0, uy0)),
+                im2, shift_affine(M, (wx0, wy0)), landmarks1, composite_mode)
+        else:
+            # 生成 mask 并 warp 到模板子图
+            warped_mask = warp_im(mask2, shift_affine(M, (wx0, wy0), (ux0, uy0)), tile_shape)
+            mask1 = np.repeat(mask1_tile[:, :, np.newaxis], 3, axis=2)
+            combined_mask = np.max([mask1, warped_mask], axis=0)
+
+            # warp user 图像并进行颜色校正
+            warped_im2 = warp_im(im2, shift_affine(M, (wx0, wy0)), tile_shape)
+            if cancelled():
+                return None
+            warped_corrected_im2 = correct_colours(im1_tile, warped_im2, landmarks1, im1_blur_tile)
+            if cancelled():
+                return None
+
+            # 融合（按 mask 权重混合）
+            blended = im1_tile * (1.0 - combined_mask) + warped_corrected_im2 * combined_mask
+            # 混合时同时存活的中间结果（含 im1_tile * (1 - mask) 等两个临时数组）
+            peak_bytes += (warped_mask.nbytes + mask1.nbytes + combined_mask.nbytes + warped_im2.nbytes +
+                           warped_corrected_im2.nbytes + 3 * blended.nbytes)
+
+            # 保存前把像素裁剪回 0-255 并转 uint8，再贴回模板
+            output_im[wy0:wy1, wx0:wx1] = np.clip(blended, 0, 255).astype(np.uint8)
+
+    if cancelled():
+        return None
+    if stats is not None:
+        stats["composite_mode"] = composite_mode
+        stats["peak_bytes"] = peak_bytes
 
     cv2.imwrite(str(out_p), output_im)
     # print(f"Saved {out_p}")
     return output_im
 
-def generate_covers(theme_id, image_path):
+# 定义不同歌手的模板路径和输出目录
+SINGER_CONFIGS = {
+    "adam": {
+        "templates": [
+            "resources/templates/adam/1.jpg",
+            "resources/templates/adam/2.jpg",
+            "resources/templates/adam/3.jpg",
+            "resources/templates/adam/4.jpg",
+        ],
+        "output_dir": "temp/adam/"
+    },
+    "angela": {
+        "templates": [
+            "resources/templates/angela/1.jpg",
+            "resources/templates/angela/2.jpg",
+            "resources/templates/angela/3.jpg",
+            "resources/templates/angela/4.jpg",
+        ],
+        "output_dir": "temp/angela/"
+    },
+    "faye": {
+        "templates": [
+            "resources/templates/faye/1.png",
+            "resources/templates/faye/2.jpg",
+            "resources/templates/faye/3.jpg",
+            "resources/templates/faye/4.jpg",
+        ],
+        "output_dir": "temp/faye/"
+    },
+    "eason": {
+        "templates": [
+            "resources/templates/eason/1.jpg",
+            "resources/templates/eason/2.jpg",
+            "resources/templates/eason/3.jpg",
+            "resources/templates/eason/4.jpg",
+        ],
+        "output_dir": "temp/eason/"
+    },
+    "michael": {
+        "templates": [
+            "resources/templates/michael/1.jpg",
+            "resources/templates/michael/2.jpg",
+            "resources/templates/michael/3.jpg",
+            "resources/templates/michael/4.jpg",
+        ],
+        "output_dir": "temp/michael/"
+    },
+    "mj": {
+        "templates": [
+            "resources/templates/mj/1.jpg",
+            "resources/templates/mj/2.jpg",
+            "resources/templates/mj/3.jpg",
+            "resources/templates/mj/4.jpg",
+        ],
+        "output_dir": "temp/mj/"
+    },
+    "gem": {
+        "templates": [
+            "resources/templates/gem/1.jpg",
+            "resources/templates/gem/2.jpg",
+            "resources/templates/gem/3.jpg",
+            "resources/templates/gem/4.jpg",
+        ],
+        "output_dir": "temp/gem/"
+    },
+    "vae": {
+        "templates": [
+            "resources/templates/vae/1.png",
+            "resources/templates/vae/2.jpg",
+            "resources/templates/vae/3.jpg",
+            "resources/templates/vae/4.jpg",
+        ],
+        "output_dir": "temp/vae/"
+    }
+}
+
+def _generate_cover(index, template_path, image_path, output_dir, template_data=None, cache_key=None,
+                    composite_mode="float64", image=None, landmarks=None, cancel_event=None):
+    """
+    生成单张封面（可在线程池或进程池中执行）
+    cache_key: 可选，封面缓存键；命中时直接返回缓存的封面，未命中时生成结果写入缓存
+    composite_mode: 融合精度，见 face_change
+    image/landmarks: 可选，已解码的用户图像及其特征点，见 face_change
+    cancel_event: 可选，被设置时尽快停止并返回 None（进程池中为 Manager 的 Event）
+    实际合成时输出本次合成的峰值内存估计（见 face_change 的 stats）
+    失败时复制用户图片作为默认封面，返回封面路径；模板不存在、已取消或复制也失败时返回 None
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        return None
+    if not os.path.exists(template_path):
+        # print(f"模板图片不存在: {template_path}")
+        return None
+
+    cache = get_cover_cache() if cache_key else None
+    if cache:
+        cached_path = cache.get(cache_key)
+        if cached_path:
+            return cached_path
+        # 先写入缓存目录中的临时文件，完成后原子替换
+        output_path = cache.temp_path(cache_key)
+    else:
+        # 生成输出路径
+        output_filename = f"cover_{index+1}.jpg"
+        output_path = os.path.join(output_dir, output_filename)
+
+    try:
+        # 调用人脸替换函数（检测器和特征点模型由注册表提供，线程/进程内各自共享）
+        stats = {}
+        result = face_change(template_path, image_path, output_path, get_detector(), get_predictor(),
+                             template_data=template_data, composite_mode=composite_mode, stats=stats,
+                             user_image=image, user_landmarks=landmarks, cancel_event=cancel_event)
+        if result is None:
+            # 已取消，没有写出封面
+            return None
+        print(f"封面合成完成: {os.path.basename(template_path)}, 精度 {stats['composite_mode']}, "
+              f"峰值内存约 {stats['peak_bytes'] / 1024 / 1024:.1f} MB")
+        if cache:
+            output_path = cache.store(cache_key, output_path)
+        # print(f"封面生成成功: {output_path}")
+        return output_path
+
+    except Exception as e:
+        # print(f"生成封面失败: {e}")
+        # 创建默认封面作为备用
+        try:
+            # 复制用户图片作为默认封面（只有内存中的图像时直接写出）
+            default_output_path = os.path.join(output_dir, f"default_{index+1}.jpg")
+            if image is not None:
+                if not cv2.imwrite(default_output_path, image):
+                    raise IOError(f"无法写入 {default_output_path}")
+            else:
+                shutil.copy2(image_path, default_output_path)
+            # print(f"创建默认封面: {default_output_path}")
+            return default_output_path
+        except Exception as copy_error:
+            print(f"创建默认封面失败: {copy_error}")
+            return None
+
+# 并发生成封面使用的执行器: (backend, workers) -> Executor，进程池常驻以避免每次重新加载模型
+_executors = {}
+_executors_lock = threading.Lock()
+# 进程池任务使用的取消标志（threading.Event 不能传给其他进程）
+_manager = None
+
+def _get_executor(backend, workers):
+    """获取（必要时创建）常驻的线程池或进程池"""
+    key = (backend, workers)
+    with _executors_lock:
+        executor = _executors.get(key)
+        if executor is None:
+            if backend == "process":
+                executor = ProcessPoolExecutor(max_workers=workers)
+            elif backend == "thread":
+                executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cover")
+            else:
+                raise ValueError(f"未知的并发后端: {backend}")
+            _executors[key] = executor
+    return executor
+
+def _get_manager():
+    """获取（必要时启动）常驻的 multiprocessing.Manager，用于创建进程间共享的取消标志"""
+    global _manager
+    with _executors_lock:
+        if _manager is None:
+            _manager = multiprocessing.Manager()
+    return _manager
+
+def generate_covers(theme_id, image_path, workers=1, backend="thread",
+                    on_cover=None, cancel_event=None, use_cache=True, composite_mode="float64",
+                    image=None, landmarks=None, image_digest=None):
     """
     生成专辑封面的主函数
+    workers: 并发生成封面的工作者数量，1 表示逐个生成
+    backend: 并发后端，"thread"（线程池）或 "process"（进程池）
+    on_cover: 可选回调 on_cover(slide_index, cover_path)，按幻灯片顺序在每张封面就绪时调用
+    cancel_event: 可选 threading.Event，被设置后放弃尚未开始的模板，正在生成的模板在下一个阶段前停止，返回 None
+    use_cache: 是否使用按内容寻址的封面缓存（相同照片和模板直接复用已生成的封面）
+    composite_mode: 融合精度，"float64"（原始算法）、"float32" 或 "uint8"（低内存），见 face_change
+    image: 可选，已解码的用户 BGR 图像（如美颜结果），提供时不再读取 image_path（image_path 可为 None）
+    landmarks: 可选，image 上已知的68点特征点，提供时跳过用户侧的人脸检测
+    image_digest: 可选，image 的像素哈希（如 ImageHandle.digest），提供时不再逐次计算
     """
     # print(f"生成封面: 歌手={theme_id}, 图片={image_path}")
     
-    predictor_path = "./resources/models/shape_predictor_68_face_landmarks.dat"
-    
-    detector = dlib.get_frontal_face_detector()
-    predictor = dlib.shape_predictor(predictor_path)
-    
-    # 定义不同歌手的模板路径和输出目录
-    singer_configs = {
-        "adam": {
-            "templates": [
-                "resources/templates/adam/1.jpg",
-                "resources/templates/adam/2.jpg",
-                "resources/templates/adam/3.jpg",
-                "resources/templates/adam/4.jpg",
-            ],
-            "output_dir": "temp/adam/"
-        },
-        "angela": {
-            "templates": [
-                "resources/templates/angela/1.jpg",
-                "resources/templates/angela/2.jpg",
-                "resources/templates/angela/3.jpg",
-                "resources/templates/angela/4.jpg",
-            ],
-            "output_dir": "temp/angela/"
-        },
-        "faye": {
-            "templates": [
-                "resources/templates/faye/1.png",
-                "resources/templates/faye/2.jpg",
-                "resources/templates/faye/3.jpg",
-                "resources/templates/faye/4.jpg",
-            ],
-            "output_dir": "temp/faye/"
-        },
-        "eason": {
-            "templates": [
-                "resources/templates/eason/1.jpg",
-                "resources/templates/eason/2.jpg",
-                "resources/templates/eason/3.jpg",
-                "resources/templates/eason/4.jpg",
-            ],
-            "output_dir": "temp/eason/"
-        },
-        "michael": {
-            "templates": [
-                "resources/templates/michael/1.jpg",
-                "resources/templates/michael/2.jpg",
-                "resources/templates/michael/3.jpg",
-                "resources/templates/michael/4.jpg",
-            ],
-            "output_dir": "temp/michael/"
-        },
-        "mj": {
-            "templates": [
-                "resources/templates/mj/1.jpg",
-                "resources/templates/mj/2.jpg",
-                "resources/templates/mj/3.jpg",
-                "resources/templates/mj/4.jpg",
-            ],
-            "output_dir": "temp/mj/"
-        },
-        "gem": {
-            "templates": [
-                "resources/templates/gem/1.jpg",
-                "resources/templates/gem/2.jpg",
-                "resources/templates/gem/3.jpg",
-                "resources/templates/gem/4.jpg",
-            ],
-            "output_dir": "temp/gem/"
-        },
-        "vae": {
-            "templates": [
-                "resources/templates/vae/1.png",
-                "resources/templates/vae/2.jpg",
-                "resources/templates/vae/3.jpg",
-                "resources/templates/vae/4.jpg",
-            ],
-            "output_dir": "temp/vae/"
-        }
-    }
-    
     # 获取当前歌手的配置
-    config = singer_configs.get(theme_id)
+    config = SINGER_CONFIGS.get(theme_id)
     if not config:
         # print(f"未找到歌手 {theme_id} 的配置")
         return None
     
     # 确保输出目录存在
     os.makedirs(config["output_dir"], exist_ok=True)
+
+    # 计算每个模板的缓存键（用户图片内容 + 模板标识 + 算法版本及融合精度）
+    cache_keys = [None] * len(config["templates"])
+    digest = None
+    if use_cache:
+        if image is not None:
+            digest = image_digest or pixel_digest(image)
+        else:
+            digest = file_digest(image_path)
+        if digest and landmarks is not None:
+            # 外部提供的特征点也会影响结果
+            digest += "-" + pixel_digest(np.asarray(landmarks, dtype=np.int64))
+    if digest:
+        cache = get_cover_cache()
+        cache_keys = [
+            cache.make_key(digest, template_path, f"{COVER_ALGORITHM_VERSION}-{composite_mode}")
+            for template_path in config["templates"]
+        ]
+
+    # 全部命中缓存时不需要模板索引
+    template_index = {}
+    if not all(key and cache.get(key) for key in cache_keys):
+        # 加载（必要时重建）模板索引，模板侧的特征点、遮罩和模糊图不再逐次计算
+        from api.template_index import load_template_index
+        template_index = load_template_index(theme_id, get_detector(), get_predictor())
     
-    # 处理每个模板
-    generated_covers = []
-    for i, template_path in enumerate(config["templates"]):
-        if not os.path.exists(template_path):
-            # print(f"模板图片不存在: {template_path}")
-            # 创建默认模板作为备用
-            continue
-            
-        # 生成输出路径
-        output_filename = f"cover_{i+1}.jpg"
-        output_path = os.path.join(config["output_dir"], output_filename)
-        
-        try:
-            # 调用人脸替换函数
-            # print(f"正在为歌手 {theme_id} 生成封面 {i+1}/{len(config['templates'])}...")
-            face_change(template_path, image_path, output_path, detector, predictor)
-            
-            # 记录生成的封面路径
-            generated_covers.append(output_path)
-            # print(f"封面生成成功: {output_path}")
-            
-        except Exception as e:
-            # print(f"生成封面失败: {e}")
-            # 创建默认封面作为备用
-            try:
-                # 复制用户图片作为默认封面
-                import shutil
-                default_output_path = os.path.join(config["output_dir"], f"default_{i+1}.jpg")
-                shutil.copy2(image_path, default_output_path)
-                generated_covers.append(default_output_path)
-                # print(f"创建默认封面: {default_output_path}")
-            except Exception as copy_error:
-                print(f"创建默认封面失败: {copy_error}")
+    # 正在生成的模板也要能响应取消：线程中直接检查 cancel_event，进程池中检查共享的取消标志
+    worker_cancel = cancel_event
+    if cancel_event is not None and workers > 1 and backend == "process":
+        worker_cancel = _get_manager().Event()
+
+    # 处理每个模板，各模板之间相互独立，可以并发执行
+    tasks = [
+        (i, template_path, image_path, config["output_dir"], template_index.get(template_path), cache_keys[i],
+         composite_mode, image, landmarks, worker_cancel)
+        for i, template_path in enumerate(config["templates"])
+    ]
+    results = [None] * len(tasks)
+    finished = [False] * len(tasks)
+    # 已按顺序回调到的模板位置和幻灯片序号（跳过不存在的模板）
+    next_task = 0
+    next_slide = 0
+
+    def is_cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    futures = {}
+    if workers > 1:
+        executor = _get_executor(backend, workers)
+        futures = {executor.submit(_generate_cover, *task): task[0] for task in tasks}
+    pending = set(futures)
+
+    for i in range(len(tasks)):
+        done = set()
+        if pending:
+            # 等待下一个完成的任务（不一定是第 i 个），期间定期检查取消
+            while not done and not is_cancelled():
+                done, _ = wait(pending, timeout=COVER_CANCEL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+
+        if is_cancelled():
+            # 取消尚未开始的任务，正在执行的任务在下一个阶段前停止
+            if worker_cancel is not cancel_event:
+                worker_cancel.set()
+            for future in futures:
+                future.cancel()
+            return None
+
+        if futures:
+            future = done.pop()
+            pending.discard(future)
+            index = futures[future]
+            results[index] = future.result()
+        else:
+            index = i
+            results[index] = _generate_cover(*tasks[i])
+        finished[index] = True
+
+        # 按模板顺序回调已就绪的封面
+        while next_task < len(tasks) and finished[next_task]:
+            cover_path = results[next_task]
+            if cover_path:
+                if on_cover and not is_cancelled():
+                    on_cover(next_slide, cover_path)
+                next_slide += 1
+            next_task += 1
+
+    if is_cancelled():
+        return None
+
+    # 保持模板顺序，跳过不存在的模板
+    generated_covers = [path for path in results if path]
     
     # 获取主题展示数据
     theme_show = get_theme_show(theme_id)
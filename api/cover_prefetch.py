@@ -0,0 +1,164 @@
+"""
+推测式封面预生成 - 用户在主题选择界面浏览时，在后台为所有主题提前生成封面
+
+美颜完成后用户照片已经确定，因此可以在用户挑选主题的几秒钟里逐个主题生成封面。
+预生成只使用一个后台线程并逐张生成模板（不占用封面生成的并发工作者），
+用户悬停或点击的主题会被移到队列最前面，生成结果保存在内存中供 LoadingState 直接使用。
+前台自行生成封面期间（pause/resume），预生成让出 CPU：正在生成的主题停止并放回队首
+（已完成的模板保存在封面缓存中，恢复后直接命中），队列暂停到前台生成结束。
+"""
+import os
+import threading
+from api.cover_generator import generate_covers
+
+
+def _image_signature(image_path):
+    """返回图片文件的 (mtime_ns, size)，用于判断预生成结果是否仍对应当前图片"""
+    try:
+        st = os.stat(image_path)
+    except (OSError, TypeError):
+        return None
+    return st.st_mtime_ns, st.st_size
+
+class CoverPrefetcher:
+    """在后台按优先级队列为多个主题预生成封面"""
+    def __init__(self, theme_ids, composite_mode="float64"):
+        self.theme_ids = list(theme_ids)
+        self.composite_mode = composite_mode
+        self._condition = threading.Condition()
+        self._queue = []
+        # theme_id -> {"covers": {幻灯片序号: 封面路径}, "done": bool, "cancelled": bool}
+        self._entries = {}
+        self._image_path = None
+        self._image_signature = None
+        # 内存中的用户图像（ImageHandle）及其特征点（美颜结果不再落盘时使用）
+        self._image = None
+        self._landmarks = None
+        self._cancel_event = threading.Event()
+        self._thread = None
+        self._paused = 0  # 前台生成的嵌套计数，大于 0 时暂停
+        self._current = None  # 正在预生成的 (theme_id, 该主题的取消标志)
+
+    def start(self, image_path, image=None, landmarks=None):
+        """
+        以 image_path 为用户照片，开始为所有主题预生成封面（取消之前的预生成）
+        image/landmarks: 可选，已解码的用户图像（ImageHandle，像素哈希只计算一次）及其特征点，见 generate_covers
+        """
+        self.stop()
+        with self._condition:
+            self._image_path = image_path
+            self._image_signature = _image_signature(image_path) if image is None else None
+            self._image = image
+            self._landmarks = landmarks
+            self._queue = list(self.theme_ids)
+            self._entries = {}
+            self._cancel_event = threading.Event()
+            # 新线程先等待旧线程退出，避免两者同时写同一主题的输出文件
+            self._thread = threading.Thread(target=self._run, args=(self._cancel_event, self._thread),
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """停止预生成，已完成的结果作废"""
+        with self._condition:
+            self._cancel_event.set()
+            if self._current:
+                self._current[1].set()
+            self._queue = []
+            self._entries = {}
+            self._condition.notify_all()
+
+    def pause(self):
+        """前台开始生成封面时调用：停止正在预生成的主题（放回队首），暂停队列直到 resume"""
+        with self._condition:
+            self._paused += 1
+            if self._current:
+                self._current[1].set()
+
+    def resume(self):
+        """前台生成结束时调用（与 pause 成对），恢复预生成"""
+        with self._condition:
+            self._paused = max(0, self._paused - 1)
+            self._condition.notify_all()
+
+    def prioritize(self, theme_id):
+        """把主题移到预生成队列最前面（用户悬停时调用）"""
+        with self._condition:
+            if theme_id in self._queue and self._queue[0] != theme_id:
+                self._queue.remove(theme_id)
+                self._queue.insert(0, theme_id)
+
+    def claim(self, theme_id, image_path, image=None):
+        """
+        用户选定主题时调用（image 为内存中的用户图像时按对象判断是否为同一张照片）
+        若该主题已经完成或正在预生成，返回对应条目（用 wait_entry 跟踪）；
+        若尚未开始，则把它移出队列并返回 None，由调用方自行生成
+        """
+        with self._condition:
+            if image_path != self._image_path or image is not self._image:
+                return None
+            if image is None and _image_signature(image_path) != self._image_signature:
+                return None
+            if theme_id in self._queue:
+                self._queue.remove(theme_id)
+                return None
+            entry = self._entries.get(theme_id)
+            if entry and not entry["cancelled"]:
+                return entry
+            return None
+
+    def wait_entry(self, entry, known_count, timeout=0.1):
+        """
+        等待条目出现新封面或完成，超时后返回
+        返回 (covers, done, cancelled) 的快照
+        """
+        with self._condition:
+            if len(entry["covers"]) <= known_count and not entry["done"]:
+                self._condition.wait(timeout)
+            return dict(entry["covers"]), entry["done"], entry["cancelled"]
+
+    def _run(self, cancel_event, previous_thread=None):
+        """后台线程：依次取出队首主题生成封面"""
+        if previous_thread is not None:
+            previous_thread.join()
+
+        while True:
+            with self._condition:
+                # 前台生成期间等待
+                while self._paused and not cancel_event.is_set():
+                    self._condition.wait()
+                if cancel_event.is_set() or not self._queue:
+                    return
+                theme_id = self._queue.pop(0)
+                entry = {"covers": {}, "done": False, "cancelled": False}
+                self._entries[theme_id] = entry
+                image_path = self._image_path
+                image, landmarks = self._image, self._landmarks
+                # 每个主题单独的取消标志，暂停时只停止当前主题
+                theme_cancel = threading.Event()
+                self._current = (theme_id, theme_cancel)
+
+            def on_cover(slide_index, cover_path, entry=entry):
+                with self._condition:
+                    entry["covers"][slide_index] = cover_path
+                    self._condition.notify_all()
+
+            try:
+                generate_covers(theme_id, image_path, workers=1,
+                                on_cover=on_cover, cancel_event=theme_cancel,
+                                composite_mode=self.composite_mode, landmarks=landmarks,
+                                image=image.bgr if image is not None else None,
+                                image_digest=image.digest if image is not None else None)
+            except Exception as e:
+                print(f"预生成封面失败 {theme_id}: {e}")
+
+            with self._condition:
+                self._current = None
+                entry["done"] = True
+                entry["cancelled"] = cancel_event.is_set() or theme_cancel.is_set()
+                if entry["cancelled"] and not cancel_event.is_set():
+                    # 因前台生成而暂停：主题放回队首，恢复后重新生成（已完成的模板命中封面缓存）
+                    if self._entries.get(theme_id) is entry:
+                        del self._entries[theme_id]
+                        self._queue.insert(0, theme_id)
+                self._condition.notify_all()
\ No newline at end of file
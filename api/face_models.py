@@ -0,0 +1,151 @@
+"""
+人脸模型注册表 - 进程内共享的 dlib 人脸检测器和68点特征点模型
+
+特征点模型约 100 MB，加载一次后由 FaceBeautifier 和 cover_generator 共同使用。
+dlib 的 HOG 检测器内部带有扫描缓冲区，并发调用不安全，因此每个线程持有一个检测器实例；
+shape_predictor 的预测是只读操作，所有线程共享同一个实例。
+
+detect_face_rects 是人脸检测的统一入口，检测分辨率和上采样次数由要检出的最小人脸边长（原图像素）决定：
+先在限制分辨率的缩小图上快速检测（只保证检出较大的人脸），没有检出人脸、或检出的人脸接近快速检测的下限
+（合影、远景，可能还有更小的人脸）时，再按原实现的最小人脸边长检测一次。检测框映射回原图，特征点仍在原图分辨率上预测。
+"""
+import os
+import threading
+import time
+import cv2
+import dlib
+
+PREDICTOR_PATH = "./resources/models/shape_predictor_68_face_landmarks.dat"
+
+# 人脸检测参数
+DETECT_MAX_SIDE = 800          # 快速检测用缩小图的长边上限（像素）
+DETECT_MIN_FACE_SIZE = 40      # 要检出的最小人脸边长（原图像素，原实现原图上采样 1 次时的下限）
+DETECT_COARSE_FACE_RATIO = 0.05  # 快速检测保证检出的最小人脸边长占图像长边的比例
+DETECT_FALLBACK_FACE_FACTOR = 2  # 检出的人脸小于快速检测下限的这个倍数时，再按 DETECT_MIN_FACE_SIZE 检测
+HOG_MIN_FACE_SIZE = 80         # HOG 检测器不上采样时能检出的最小人脸边长（像素）
+DETECT_MAX_UPSAMPLE = 1        # 上采样次数上限（原实现固定为 1）
+
+_lock = threading.Lock()
+_thread_local = threading.local()
+_predictors = {}
+_load_stats = {}
+
+
+def _current_rss():
+    """返回当前进程的常驻内存字节数，无法获取时返回 None"""
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        import resource
+        # Linux 上 ru_maxrss 单位为 KB（峰值，作为近似值）
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+def _record_load(name, start_time, start_rss):
+    """记录一次模型加载的耗时和内存增量"""
+    end_rss = _current_rss()
+    memory = None
+    if start_rss is not None and end_rss is not None:
+        memory = end_rss - start_rss
+    _load_stats[name] = {
+        "load_time": time.perf_counter() - start_time,
+        "memory": memory,
+    }
+    memory_text = f"{memory / 1024 / 1024:.1f} MB" if memory is not None else "未知"
+    print(f"模型加载完成: {name}, 耗时 {_load_stats[name]['load_time']:.2f}s, 内存 {memory_text}")
+
+def get_detector():
+    """获取当前线程的人脸检测器（首次调用时创建）"""
+    detector = getattr(_thread_local, "detector", None)
+    if detector is None:
+        start_time = time.perf_counter()
+        start_rss = _current_rss()
+        detector = dlib.get_frontal_face_detector()
+        _thread_local.detector = detector
+        with _lock:
+            if "detector" not in _load_stats:
+                _record_load("detector", start_time, start_rss)
+    return detector
+
+def get_predictor(predictor_path=PREDICTOR_PATH):
+    """获取共享的68点特征点模型（每个进程只加载一次）"""
+    predictor = _predictors.get(predictor_path)
+    if predictor is not None:
+        return predictor
+
+    with _lock:
+        predictor = _predictors.get(predictor_path)
+        if predictor is None:
+            start_time = time.perf_counter()
+            start_rss = _current_rss()
+            predictor = dlib.shape_predictor(predictor_path)
+            _predictors[predictor_path] = predictor
+            _record_load(os.path.basename(predictor_path), start_time, start_rss)
+    return predictor
+
+def plan_detection(image_shape, min_face_size, max_side=None):
+    """
+    选择能检出边长不小于 min_face_size（原图像素）的人脸的检测方式
+    优先缩小到 max_side 以内，每次上采样使可检出尺寸减半，上采样次数用尽仍不够时提高检测分辨率（不超过原图）
+    Returns:
+        (scale, upsample): 检测图相对原图的缩放比例和上采样次数
+    """
+    long_side = max(image_shape[:2])
+    scale = min(1.0, max_side / long_side) if max_side else 1.0
+    upsample = 0
+    while min_face_size * scale * (2 ** upsample) < HOG_MIN_FACE_SIZE and upsample < DETECT_MAX_UPSAMPLE:
+        upsample += 1
+    needed = HOG_MIN_FACE_SIZE / (min_face_size * (2 ** upsample))
+    return min(1.0, max(scale, needed)), upsample
+
+def _detect_scaled(image, detector, scale, upsample):
+    """在缩放 scale 后的图像上检测，返回原图坐标系下的 dlib.rectangle 列表"""
+    if scale >= 1.0:
+        return list(detector(image, upsample))
+
+    h, w = image.shape[:2]
+    small = cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))),
+                       interpolation=cv2.INTER_AREA)
+    rects = detector(small, upsample)
+
+    # 把检测框映射回原图分辨率
+    return [
+        dlib.rectangle(int(round(r.left() / scale)), int(round(r.top() / scale)),
+                       int(round(r.right() / scale)), int(round(r.bottom() / scale)))
+        for r in rects
+    ]
+
+def detect_face_rects(image, detector=None, max_side=DETECT_MAX_SIDE, min_face_size=DETECT_MIN_FACE_SIZE):
+    """
+    检测人脸，返回原图坐标系下的 dlib.rectangle 列表
+    image: BGR 或 RGB 图像（检测器对两者都适用）
+    max_side: 快速检测用图像的长边上限，None 表示直接按 min_face_size 检测
+    min_face_size: 要检出的最小人脸边长（原图像素）
+    """
+    if detector is None:
+        detector = get_detector()
+
+    fine_plan = plan_detection(image.shape, min_face_size)
+    if not max_side:
+        return _detect_scaled(image, detector, *fine_plan)
+    coarse_face = max(min_face_size, max(image.shape[:2]) * DETECT_COARSE_FACE_RATIO)
+    coarse_plan = plan_detection(image.shape, coarse_face, max_side)
+    if coarse_plan[0] * (2 ** coarse_plan[1]) >= fine_plan[0] * (2 ** fine_plan[1]):
+        # 快速检测的分辨率已足够检出最小的人脸（小图）
+        return _detect_scaled(image, detector, *coarse_plan)
+
+    rects = _detect_scaled(image, detector, *coarse_plan)
+    # 没有检出人脸，或检出了接近下限的小脸（合影、远景）时，可能还有快速检测看不到的更小的人脸
+    if not rects or min(min(r.width(), r.height()) for r in rects) < coarse_face * DETECT_FALLBACK_FACE_FACTOR:
+        rects = _detect_scaled(image, detector, *fine_plan)
+    return rects
+
+def get_model_stats():
+    """返回已加载模型的统计信息 {name: {"load_time": 秒, "memory": 字节或 None}}"""
+    with _lock:
+        return {name: dict(stats) for name, stats in _load_stats.items()}
\ No newline at end of file
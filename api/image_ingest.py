@@ -0,0 +1,180 @@
+"""
+照片导入 - 选择文件时把上传的照片解码为各阶段共享的 ImageHandle
+
+手机照片常见 12~48 MP，而后续各阶段（预览、人脸检测、美颜、封面合成）最终只需要封面模板大小的像素。
+导入时只解码一次：按 EXIF 方向转正，JPEG 利用 DCT 缩放直接以 1/2、1/4、1/8 尺寸解码，
+再把长边限制在工作分辨率以内。解码结果由 ImageHandle 持有，RGB、像素哈希、界面预览等视图在第一次使用时派生，
+UploadState、BeautifyState、LoadingState 之间传递 ImageHandle 而不是文件路径，单张照片在一次会话中只解码一次。
+"""
+import os
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+from PIL import Image
+from api.cover_generator import SINGER_CONFIGS
+from api.landmark_store import pixel_digest
+
+IMAGE_HANDLE_CACHE_SIZE = 4  # open_image 在内存中保留的已解码照片数量
+INGEST_DEFAULT_MAX_SIDE = 2048  # 无法读取模板尺寸时使用的工作分辨率（长边像素）
+# JPEG 缩小解码允许的最小尺寸（相对工作分辨率），换取只解码 1/4 或更少的像素
+INGEST_MIN_DECODE_RATIO = 0.75
+
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+_template_max_side = None
+_template_max_side_lock = threading.Lock()
+
+# (路径, mtime, 大小, 工作分辨率) -> ImageHandle，按最近使用排序
+_handles = OrderedDict()
+_handles_lock = threading.Lock()
+
+
+def template_max_side(default=INGEST_DEFAULT_MAX_SIDE):
+    """所有封面模板中最大的边长（只读取文件头），没有可读取的模板时返回 default"""
+    global _template_max_side
+    with _template_max_side_lock:
+        if _template_max_side is None:
+            sides = []
+            for config in SINGER_CONFIGS.values():
+                for template_path in config["templates"]:
+                    try:
+                        with Image.open(template_path) as template:
+                            sides.append(max(template.size))
+                    except (OSError, ValueError):
+                        continue
+            _template_max_side = max(sides) if sides else 0
+    return _template_max_side or default
+
+def probe_image(image_path):
+    """只读取文件头，返回 ((宽, 高), 格式)；宽高为转正前的尺寸（长边不受方向影响）"""
+    with Image.open(image_path) as image:
+        return image.size, image.format
+
+def decode_capped(image_path, max_side):
+    """
+    解码照片为 BGR 数组：按 EXIF 方向转正（cv2 解码时自动处理），长边不超过 max_side（None 表示不限制）
+    JPEG 在 DCT 阶段直接以 1/2、1/4、1/8 尺寸解码，其余格式完整解码后再缩小
+    """
+    (width, height), image_format = probe_image(image_path)
+    flags = cv2.IMREAD_COLOR
+    if image_format == "JPEG" and max_side:
+        for factor, reduced_flags in _REDUCED_FLAGS:
+            if max(width, height) / factor >= max_side * INGEST_MIN_DECODE_RATIO:
+                flags = reduced_flags
+                break
+
+    # 通过 imdecode 读取，路径中含非 ASCII 字符时同样可用
+    image_bgr = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), flags)
+    if image_bgr is None:
+        raise ValueError(f"无法读取图片: {image_path}")
+
+    height, width = image_bgr.shape[:2]
+    if max_side and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        image_bgr = cv2.resize(image_bgr, (max(1, round(width * scale)), max(1, round(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+    return image_bgr
+
+def fit_size(size, max_size):
+    """按比例缩放 (宽, 高) 使其恰好放进 max_size"""
+    scale = min(max_size[0] / size[0], max_size[1] / size[1])
+    return max(1, int(size[0] * scale)), max(1, int(size[1] * scale))
+
+def decode_preview(image_path, max_size):
+    """
+    解码界面预览：按 EXIF 方向转正，按比例缩放到恰好放进 max_size (宽, 高)，返回 BGR 数组
+    JPEG 选择仍能覆盖预览尺寸的最大 DCT 缩小倍数解码，只解码约等于显示尺寸的像素
+    """
+    (width, height), image_format = probe_image(image_path)
+    flags = cv2.IMREAD_COLOR
+    if image_format == "JPEG":
+        # 转正前无法得知方向，按横竖两种方向中较大的预览尺寸选择倍数
+        landscape = fit_size((width, height), max_size)
+        portrait = fit_size((height, width), max_size)
+        need_width = max(landscape[0], portrait[1])
+        need_height = max(landscape[1], portrait[0])
+        for factor, reduced_flags in _REDUCED_FLAGS:
+            if width / factor >= need_width and height / factor >= need_height:
+                flags = reduced_flags
+                break
+
+    image_bgr = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), flags)
+    if image_bgr is None:
+        raise ValueError(f"无法读取图片: {image_path}")
+
+    size = (image_bgr.shape[1], image_bgr.shape[0])
+    new_size = fit_size(size, max_size)
+    if new_size != size:
+        interpolation = cv2.INTER_AREA if new_size[0] < size[0] else cv2.INTER_LINEAR
+        image_bgr = cv2.resize(image_bgr, new_size, interpolation=interpolation)
+    return image_bgr
+
+class ImageHandle:
+    """
+    解码一次的图像：持有只读的 BGR 像素，其他视图在第一次使用时派生并缓存（线程安全）
+    derive 供调用方缓存自定义的派生结果（如界面层的 pygame Surface）
+    """
+    def __init__(self, image_bgr, path=None):
+        self._bgr = image_bgr
+        self._bgr.flags.writeable = False
+        self.path = path  # 来源文件路径（仅用于显示和日志），内存中生成的图像为 None
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    @property
+    def bgr(self):
+        """只读的 BGR 数组"""
+        return self._bgr
+
+    @property
+    def size(self):
+        """(宽, 高)"""
+        return self._bgr.shape[1], self._bgr.shape[0]
+
+    @property
+    def rgb(self):
+        """只读的 RGB 数组"""
+        return self.derive("rgb", lambda: self._readonly(cv2.cvtColor(self._bgr, cv2.COLOR_BGR2RGB)))
+
+    @property
+    def digest(self):
+        """像素内容哈希（与 landmark_store.pixel_digest 相同）"""
+        return self.derive("digest", lambda: pixel_digest(self._bgr))
+
+    def derive(self, key, compute):
+        """返回以 key 缓存的派生结果，不存在时调用 compute() 计算"""
+        with self._lock:
+            if key in self._derived:
+                return self._derived[key]
+        value = compute()
+        with self._lock:
+            return self._derived.setdefault(key, value)
+
+    @staticmethod
+    def _readonly(array):
+        array.flags.writeable = False
+        return array
+
+def open_image(image_path, max_side=None):
+    """
+    导入一张照片：解码为长边不超过工作分辨率的正向图像，返回 ImageHandle
+    max_side: 工作分辨率（长边像素），None 表示取封面模板的最大边长
+    同一文件（路径、mtime、大小不变）重复导入时直接返回之前的 ImageHandle
+    """
+    if max_side is None:
+        max_side = template_max_side()
+    st = os.stat(image_path)
+    key = (os.path.abspath(image_path), st.st_mtime_ns, st.st_size, max_side)
+    with _handles_lock:
+        handle = _handles.get(key)
+        if handle is not None:
+            _handles.move_to_end(key)
+            return handle
+
+    handle = ImageHandle(decode_capped(image_path, max_side), image_path)
+    with _handles_lock:
+        _handles[key] = handle
+        while len(_handles) > IMAGE_HANDLE_CACHE_SIZE:
+            _handles.popitem(last=False)
+    return handle
\ No newline at end of file
@@ -0,0 +1,209 @@
+"""
+特征点存储 - 按解码后像素内容哈希缓存人脸特征点
+
+同一张用户照片会先在 FaceBeautifier.detect_faces 中检测一次，生成封面时又在 face_change 中按模板各检测一次。
+特征点只取决于像素内容，因此以像素哈希为键保存检测结果：内存中保留最近使用的若干条（LRU），
+并可选地持久化到磁盘，之后对同一图像的请求直接查表，不再调用 dlib。
+磁盘上的结果按总大小和存放时间淘汰：超过时长未使用的条目被删除，总大小超出预算时先淘汰最久未使用的条目。
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+from api.face_models import get_detector, get_predictor, detect_face_rects
+
+# 存储格式版本，修改检测流程（检测参数、颜色空间等）时需要递增，使旧的持久化结果失效
+LANDMARK_STORE_VERSION = 2
+LANDMARK_STORE_DIR = "temp/landmark_cache"
+LANDMARK_STORE_MAX_ENTRIES = 32
+LANDMARK_STORE_MAX_BYTES = 4 * 1024 * 1024  # 4 MB（单张人脸的结果约 1 KB）
+LANDMARK_STORE_MAX_AGE = 30 * 24 * 3600  # 30 天未使用的结果被删除
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def pixel_digest(image):
+    """计算解码后像素的 sha1（包含形状和数据类型），与文件编码方式无关"""
+    image = np.ascontiguousarray(image)
+    sha1 = hashlib.sha1(f"{image.shape}|{image.dtype}|".encode("utf-8"))
+    sha1.update(memoryview(image).cast("B"))
+    return sha1.hexdigest()
+
+class LandmarkStore:
+    """以像素哈希为键的人脸特征点存储（内存 LRU + 可选磁盘持久化）"""
+    def __init__(self, max_entries=LANDMARK_STORE_MAX_ENTRIES, persist_dir=LANDMARK_STORE_DIR,
+                 max_bytes=LANDMARK_STORE_MAX_BYTES, max_age=LANDMARK_STORE_MAX_AGE):
+        """
+        max_entries: 内存中最多保留的图像条目数
+        persist_dir: 持久化目录，None 表示只保存在内存中
+        max_bytes: 持久化结果的总大小预算
+        max_age: 持久化结果最多保留的秒数（从最近一次使用算起），None 表示不按时间淘汰
+        """
+        self.max_entries = max_entries
+        self.persist_dir = persist_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 正在检测的键 -> Event，同一图像并发请求时只检测一次
+        self._pending = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.persist_dir:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            # 清理以前运行留下的过期结果
+            self.evict()
+
+    def _path(self, key):
+        return os.path.join(self.persist_dir, f"{key}.npy")
+
+    def _remember(self, key, faces):
+        """放入内存 LRU（调用方持有锁）"""
+        self._entries[key] = faces
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self, key):
+        """从磁盘读取持久化的特征点，不存在或损坏时返回 None"""
+        if not self.persist_dir:
+            return None
+        path = self._path(key)
+        try:
+            faces = np.load(path, allow_pickle=False)
+            # 刷新最近使用时间，避免常用的结果被淘汰
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return [face for face in faces]
+
+    def _save(self, key, faces):
+        """原子地把特征点写入磁盘"""
+        if not self.persist_dir:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.array(faces, dtype=np.int64).reshape(len(faces), 68, 2))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"保存特征点失败: {e}")
+            return
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """删除过期的持久化结果，再淘汰最久未使用的结果直到总大小不超过预算（keep 指定的文件不会被淘汰）"""
+        if not self.persist_dir:
+            return
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.persist_dir):
+                if not name.endswith(".npy"):
+                    continue
+                path = os.path.join(self.persist_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+
+            expire_ns = None
+            if self.max_age is not None:
+                expire_ns = time.time_ns() - int(self.max_age * 1e9)
+            entries.sort()
+            for mtime_ns, size, path in entries:
+                expired = expire_ns is not None and mtime_ns < expire_ns
+                if not expired and total <= self.max_bytes:
+                    break
+                if keep and os.path.abspath(path) == os.path.abspath(keep):
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+    def get(self, key):
+        """查找特征点，命中时返回人脸特征点列表（每张脸为 (68, 2) 数组），未命中返回 None"""
+        with self._lock:
+            faces = self._entries.get(key)
+            if faces is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return faces
+
+        faces = self._load(key)
+        with self._lock:
+            if faces is not None:
+                self._remember(key, faces)
+                self.disk_hits += 1
+            return faces
+
+    def put(self, key, faces):
+        """保存一张图像的特征点列表（可以为空列表，表示未检测到人脸）"""
+        faces = [np.asarray(face, dtype=np.int64) for face in faces]
+        with self._lock:
+            self._remember(key, faces)
+        self._save(key, faces)
+
+    def find_landmarks(self, image, detector=None, predictor=None, digest=None):
+        """
+        返回图像中所有人脸的68点特征点列表，优先查表，未命中时检测并保存
+        image: BGR 图像（检测在 RGB 上进行，与 FaceBeautifier 原有流程一致）
+        digest: 可选，调用方已知的 pixel_digest(image)，避免重复计算
+        """
+        key = f"{LANDMARK_STORE_VERSION}-{digest or pixel_digest(image)}"
+        while True:
+            faces = self.get(key)
+            if faces is not None:
+                return faces
+            with self._lock:
+                pending = self._pending.get(key)
+                if pending is None:
+                    self._pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # 其他线程正在检测同一图像，等待其结果
+            pending.wait()
+
+        try:
+            if detector is None:
+                detector = get_detector()
+            if predictor is None:
+                predictor = get_predictor()
+            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            faces = [
+                np.array([[p.x, p.y] for p in predictor(image_rgb, rect).parts()], dtype=np.int64)
+                for rect in detect_face_rects(image_rgb, detector)
+            ]
+            self.put(key, faces)
+            return faces
+        finally:
+            with self._lock:
+                self._pending.pop(key).set()
+
+    def stats(self):
+        """返回命中统计 {"hits", "disk_hits", "misses", "entries"}"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+def get_landmark_store():
+    """获取进程内共享的默认特征点存储"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = LandmarkStore()
+    return _default_store
\ No newline at end of file
@@ -0,0 +1,202 @@
+"""
+模板索引 - 离线预计算模板侧的人脸特征点、遮罩和颜色校正模糊图
+
+模板图片是静态资源，它们的特征点、脸部遮罩和颜色校正用的模糊图与用户照片无关，
+因此按歌手保存到 resources/templates/<singer>/template_index.npz 中，
+生成封面时只需要处理用户的人脸。索引按模板文件的 mtime/大小/内容哈希失效。
+遮罩和模糊图只保存脸部附近的子图；进程内最多保留 TEMPLATE_INDEX_CACHE_SIZE 个歌手的索引（LRU）。
+
+离线构建全部歌手的索引:
+    python -m api.template_index
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+from api.cover_generator import SINGER_CONFIGS, prepare_template
+from api.face_models import get_detector, get_predictor
+
+# 索引格式版本，修改 prepare_template 的算法或存储格式时需要递增
+TEMPLATE_INDEX_VERSION = 4
+TEMPLATE_INDEX_FILENAME = "template_index.npz"
+TEMPLATE_INDEX_CACHE_SIZE = 3  # 进程内保留的歌手索引数量
+
+# 进程内缓存: theme_id -> (模板签名, {template_path: template_data})，按最近使用排序
+_loaded_indexes = OrderedDict()
+_loaded_indexes_lock = threading.Lock()
+
+
+def get_index_path(theme_id):
+    """返回歌手模板索引文件的路径（与模板图片放在同一目录）"""
+    templates = SINGER_CONFIGS[theme_id]["templates"]
+    return os.path.join(os.path.dirname(templates[0]), TEMPLATE_INDEX_FILENAME)
+
+def _file_signature(path):
+    """返回 (mtime_ns, size)，文件不存在时返回 (-1, -1)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return -1, -1
+    return st.st_mtime_ns, st.st_size
+
+def _file_hash(path):
+    """计算文件内容的 sha1"""
+    if not os.path.exists(path):
+        return ""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def _read_index(index_path, template_paths):
+    """
+    读取索引文件中仍然有效的记录
+    返回 {template_path: record}，record 包含 signature、hash、data（检测失败时为 None）
+    """
+    records = {}
+    if not os.path.exists(index_path):
+        return records
+
+    try:
+        with np.load(index_path, allow_pickle=False) as data:
+            if int(data["version"]) != TEMPLATE_INDEX_VERSION:
+                return records
+
+            for i, path in enumerate(str(p) for p in data["paths"]):
+                if path not in template_paths:
+                    continue
+
+                signature = _file_signature(path)
+                stored_signature = (int(data["mtimes"][i]), int(data["sizes"][i]))
+                stored_hash = str(data["hashes"][i])
+                if signature != stored_signature:
+                    # mtime 变化时再比较内容哈希，内容未变则记录仍然有效
+                    if _file_hash(path) != stored_hash:
+                        continue
+
+                template_data = None
+                if bool(data["valid"][i]):
+                    template_data = {
+                        "landmarks": np.matrix(data[f"landmarks_{i}"]),
+                        "mask": data[f"mask_{i}"],
+                        "mask_offset": tuple(int(v) for v in data[f"mask_offset_{i}"]),
+                        "blur": data[f"blur_{i}"],
+                        "blur_offset": tuple(int(v) for v in data[f"blur_offset_{i}"]),
+                    }
+                records[path] = {
+                    "signature": signature,
+                    "hash": stored_hash,
+                    "data": template_data,
+                }
+    except Exception as e:
+        print(f"读取模板索引失败: {e}")
+        return {}
+
+    return records
+
+def _build_record(template_path, detector, predictor):
+    """为单个模板计算索引记录"""
+    record = {
+        "signature": _file_signature(template_path),
+        "hash": _file_hash(template_path),
+        "data": None,
+    }
+    if not os.path.exists(template_path):
+        return record
+
+    im1 = cv2.imread(template_path, cv2.IMREAD_COLOR)
+    if im1 is None:
+        return record
+
+    try:
+        record["data"] = prepare_template(im1, detector, predictor)
+    except Exception as e:
+        print(f"模板人脸检测失败 {template_path}: {e}")
+    return record
+
+def _write_index(index_path, template_paths, records):
+    """原子地写入索引文件（先写临时文件再替换）"""
+    arrays = {
+        "version": np.array(TEMPLATE_INDEX_VERSION),
+        "paths": np.array(template_paths),
+        "mtimes": np.array([records[p]["signature"][0] for p in template_paths], dtype=np.int64),
+        "sizes": np.array([records[p]["signature"][1] for p in template_paths], dtype=np.int64),
+        "hashes": np.array([records[p]["hash"] for p in template_paths]),
+        "valid": np.array([records[p]["data"] is not None for p in template_paths]),
+    }
+    for i, path in enumerate(template_paths):
+        template_data = records[path]["data"]
+        if template_data is None:
+            continue
+        arrays[f"landmarks_{i}"] = np.asarray(template_data["landmarks"])
+        arrays[f"mask_{i}"] = template_data["mask"]
+        arrays[f"mask_offset_{i}"] = np.array(template_data["mask_offset"], dtype=np.int64)
+        arrays[f"blur_{i}"] = template_data["blur"]
+        arrays[f"blur_offset_{i}"] = np.array(template_data["blur_offset"], dtype=np.int64)
+
+    # 临时文件按进程和线程区分，多个线程/进程同时重建同一索引时不会写入同一个文件
+    tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, index_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_template_index(theme_id, detector, predictor, rebuild=True):
+    """
+    加载歌手的模板索引
+    rebuild: 索引缺失或失效时是否立即重建并写回磁盘
+    返回 {template_path: template_data}，只包含检测成功的模板
+    """
+    config = SINGER_CONFIGS.get(theme_id)
+    if not config:
+        return {}
+
+    template_paths = list(config["templates"])
+    signatures = tuple(_file_signature(p) for p in template_paths)
+    with _loaded_indexes_lock:
+        cached = _loaded_indexes.get(theme_id)
+        if cached and cached[0] == signatures:
+            _loaded_indexes.move_to_end(theme_id)
+            return cached[1]
+
+    index_path = get_index_path(theme_id)
+    records = _read_index(index_path, template_paths)
+    stale_paths = [p for p in template_paths if p not in records]
+
+    if stale_paths:
+        if not rebuild:
+            return {p: r["data"] for p, r in records.items() if r["data"] is not None}
+
+        for path in stale_paths:
+            records[path] = _build_record(path, detector, predictor)
+        try:
+            _write_index(index_path, template_paths, records)
+        except Exception as e:
+            print(f"写入模板索引失败: {e}")
+
+    entries = {p: r["data"] for p, r in records.items() if r["data"] is not None}
+    with _loaded_indexes_lock:
+        _loaded_indexes[theme_id] = (signatures, entries)
+        _loaded_indexes.move_to_end(theme_id)
+        while len(_loaded_indexes) > TEMPLATE_INDEX_CACHE_SIZE:
+            _loaded_indexes.popitem(last=False)
+    return entries
+
+def build_all_indexes():
+    """离线构建所有歌手的模板索引"""
+    detector = get_detector()
+    predictor = get_predictor()
+
+    for theme_id, config in SINGER_CONFIGS.items():
+        entries = load_template_index(theme_id, detector, predictor)
+        print(f"{theme_id}: {len(entries)}/{len(config['templates'])} 个模板已索引 -> {get_index_path(theme_id)}")
+
+
+if __name__ == "__main__":
+    build_all_indexes()
\ No newline at end of file
@@ -0,0 +1,331 @@
+"""
+开场视频缓存 - 预先转码为屏幕分辨率、解码开销低的版本
+
+开场视频以源分辨率（如 1080p）编码，每次启动都要逐帧解码大尺寸画面再缩放到屏幕尺寸。
+首次播放后在后台把视频转码为屏幕尺寸的 MJPEG（AVI 容器，OpenCV 内置编解码器，帧间无依赖，每帧解码开销稳定），
+并把音轨提取为 WAV，一起保存在缓存目录，之后的启动直接播放缓存，不再逐帧缩放。
+音轨提取需要运行 ffmpeg，只在后台进行；无法提取时（没有 ffmpeg、视频没有音轨等）记录"不可用"标记，
+之后的启动不再尝试（标记原因为没有 ffmpeg 时，安装 ffmpeg 后标记自动失效）。
+缓存文件名包含源视频内容哈希、输出尺寸和转码版本，源视频变化后旧的缓存自动失效并被清理；
+源视频的哈希按 (mtime, 大小) 记录，文件未变化时不重复计算；启动时的查找（lookup、audio_unavailable）只读取记录，
+从不计算哈希，尚未记录的源视频视为未缓存，哈希由后台的 prepare / extract_audio 计算。写入通过临时文件 + 替换保证原子性。
+"""
+import os
+import json
+import shutil
+import hashlib
+import subprocess
+import threading
+import cv2
+from api.cover_cache import file_digest
+
+VIDEO_CACHE_DIR = "temp/video_cache"
+# 转码格式版本，修改转码参数（编码、质量、缩放方式等）时需要递增，使旧的缓存失效
+VIDEO_CACHE_VERSION = 1
+VIDEO_CACHE_QUALITY = 90  # MJPEG 压缩质量（0~100）
+# 音轨"不可用"标记中记录的原因
+AUDIO_UNAVAILABLE_NO_FFMPEG = "no-ffmpeg"
+AUDIO_UNAVAILABLE_FAILED = "failed"
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+class VideoCache:
+    """按源视频内容哈希寻址的开场视频缓存"""
+    def __init__(self, cache_dir=VIDEO_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        # 正在提取的音轨路径 -> Event，同一源视频并发请求时只提取一次
+        self._pending = {}
+        # 暂停计数：大于 0 时后台转码在帧之间等待，让出 CPU 给前台任务
+        self._paused = 0
+        self._pause_condition = threading.Condition()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _record_path(self, source_path):
+        """记录源视频哈希的文件（按源视频的绝对路径区分）"""
+        name = hashlib.sha1(os.path.abspath(source_path).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.json")
+
+    def video_path(self, digest, size):
+        """转码后视频的缓存路径"""
+        return os.path.join(self.cache_dir, f"{digest}-{size[0]}x{size[1]}-v{VIDEO_CACHE_VERSION}.avi")
+
+    def audio_path(self, digest):
+        """提取出的音轨的缓存路径"""
+        return os.path.join(self.cache_dir, f"{digest}.wav")
+
+    def _unavailable_path(self, digest):
+        """音轨"不可用"标记的路径"""
+        return os.path.join(self.cache_dir, f"{digest}.noaudio")
+
+    def _read_record(self, record_path):
+        """读取源视频的哈希记录，不存在或损坏时返回 None"""
+        try:
+            with open(record_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def recorded_digest(self, source_path):
+        """
+        记录中的源视频哈希（不计算哈希）
+        源视频不存在、尚未记录或 (mtime, 大小) 与记录不同时返回 None
+        """
+        try:
+            st = os.stat(source_path)
+        except OSError:
+            return None
+        record = self._read_record(self._record_path(source_path))
+        if record and record.get("mtime_ns") == st.st_mtime_ns and record.get("size") == st.st_size:
+            return record["digest"]
+        return None
+
+    def source_digest(self, source_path):
+        """
+        源视频内容的 sha1，(mtime, 大小) 与上次记录相同时直接返回记录的哈希
+        哈希变化时删除旧哈希对应的缓存文件；源视频不存在时返回 None
+        需要读取整个源视频时耗时较长，只在后台线程中调用
+        """
+        try:
+            st = os.stat(source_path)
+        except OSError:
+            return None
+        record_path = self._record_path(source_path)
+        with self._lock:
+            record = self._read_record(record_path)
+            if record and record.get("mtime_ns") == st.st_mtime_ns and record.get("size") == st.st_size:
+                return record["digest"]
+
+            digest = file_digest(source_path)
+            if digest is None:
+                return None
+            if record and record.get("digest") != digest:
+                self._remove_entries(record.get("digest"))
+            tmp_path = f"{record_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"mtime_ns": st.st_mtime_ns, "size": st.st_size, "digest": digest}, f)
+                os.replace(tmp_path, record_path)
+            except OSError as e:
+                print(f"保存视频缓存记录失败: {e}")
+            return digest
+
+    def _remove_entries(self, digest):
+        """删除某个源视频哈希对应的所有缓存文件（调用方持有锁）"""
+        if not digest:
+            return
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(digest):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def lookup(self, source_path, size):
+        """
+        查找源视频在 size (宽, 高) 下的缓存（只读取哈希记录，可在主线程中调用）
+        Returns:
+            (视频路径, 音频路径)，尚未缓存的部分为 None；源视频的哈希尚未记录时都为 None
+        """
+        digest = self.recorded_digest(source_path)
+        if digest is None:
+            return None, None
+        video_path = self.video_path(digest, size)
+        audio_path = self.audio_path(digest)
+        return (video_path if os.path.exists(video_path) else None,
+                audio_path if os.path.exists(audio_path) else None)
+
+    def audio_unavailable(self, source_path):
+        """源视频的音轨是否已被记录为无法提取（不运行外部程序，只读取哈希记录）"""
+        digest = self.recorded_digest(source_path)
+        return digest is not None and self._is_unavailable(digest)
+
+    def _is_unavailable(self, digest):
+        """读取"不可用"标记；原因为没有 ffmpeg 而现在已能找到 ffmpeg 时删除标记"""
+        marker_path = self._unavailable_path(digest)
+        try:
+            with open(marker_path, "r", encoding="utf-8") as f:
+                reason = f.read().strip()
+        except OSError:
+            return False
+        if reason == AUDIO_UNAVAILABLE_NO_FFMPEG and shutil.which("ffmpeg"):
+            try:
+                os.remove(marker_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def _mark_unavailable(self, digest, reason):
+        """记录音轨无法提取及其原因"""
+        marker_path = self._unavailable_path(digest)
+        tmp_path = self._temp_path(marker_path)
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(reason)
+            os.replace(tmp_path, marker_path)
+        except OSError as e:
+            print(f"保存音频不可用标记失败: {e}")
+
+    def extract_audio(self, source_path):
+        """
+        提取源视频的音轨并缓存，返回 WAV 路径（已缓存时直接返回）
+        无法提取时记录"不可用"标记并返回 None，之后的调用不再运行 ffmpeg
+        """
+        digest = self.source_digest(source_path)
+        if digest is None:
+            return None
+        path = self.audio_path(digest)
+        while True:
+            if os.path.exists(path):
+                return path
+            if self._is_unavailable(digest):
+                return None
+            with self._lock:
+                pending = self._pending.get(path)
+                if pending is None:
+                    self._pending[path] = threading.Event()
+                    break
+            # 其他线程正在提取同一音轨，等待其结果
+            pending.wait()
+
+        try:
+            self._extract_audio(source_path, path)
+            return path
+        except FileNotFoundError:
+            print("音频提取失败: 找不到 ffmpeg")
+            self._mark_unavailable(digest, AUDIO_UNAVAILABLE_NO_FFMPEG)
+        except subprocess.CalledProcessError as e:
+            # ffmpeg 报错（如视频没有音轨），同一源视频再次尝试也会失败
+            print(f"音频提取失败: ffmpeg 返回 {e.returncode}")
+            self._mark_unavailable(digest, AUDIO_UNAVAILABLE_FAILED)
+        except OSError as e:
+            # 磁盘等临时错误不记录标记，下次仍会尝试
+            print(f"音频提取失败: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(path).set()
+        return None
+
+    def pause(self):
+        """暂停后台转码（可嵌套，与 resume 成对调用）"""
+        with self._pause_condition:
+            self._paused += 1
+
+    def resume(self):
+        """恢复后台转码"""
+        with self._pause_condition:
+            self._paused = max(0, self._paused - 1)
+            self._pause_condition.notify_all()
+
+    def _wait_while_paused(self, cancel_event=None):
+        """暂停期间阻塞，被取消时立即返回"""
+        with self._pause_condition:
+            while self._paused and (cancel_event is None or not cancel_event.is_set()):
+                self._pause_condition.wait(0.1)
+
+    def prepare(self, source_path, size, cancel_event=None):
+        """
+        准备源视频在 size (宽, 高) 下的缓存：转码视频并提取音轨，已经缓存或已记录为不可用的部分跳过
+        cancel_event: 可选，被设置时尽快停止（未完成的文件不会进入缓存）
+        pause() 期间在帧之间等待，resume() 后继续
+        Returns:
+            (视频路径, 音频路径)，失败或被取消的部分为 None
+        """
+        digest = self.source_digest(source_path)
+        if digest is None:
+            return None, None
+        self._remove_stale_temp_files()
+
+        video_path = self.video_path(digest, size)
+        if not os.path.exists(video_path):
+            try:
+                if not self._transcode(source_path, video_path, size, cancel_event):
+                    video_path = None
+            except Exception as e:
+                print(f"开场视频转码失败: {e}")
+                video_path = None
+
+        audio_path = None
+        self._wait_while_paused(cancel_event)
+        if cancel_event is None or not cancel_event.is_set():
+            audio_path = self.extract_audio(source_path)
+        return video_path, audio_path
+
+    def _temp_path(self, path):
+        """写入用的临时路径（保留扩展名以便编码器识别格式）"""
+        root, ext = os.path.splitext(path)
+        return f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+
+    def _remove_stale_temp_files(self):
+        """删除其他进程（如中途退出的上次运行）遗留的临时文件"""
+        own_marker = f".{os.getpid()}."
+        for name in os.listdir(self.cache_dir):
+            if ".tmp" in name and own_marker not in name:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def _transcode(self, source_path, path, size, cancel_event=None):
+        """把源视频逐帧缩放到 size 并以 MJPEG 写入 path，被取消时返回 False"""
+        cap = cv2.VideoCapture(source_path)
+        if not cap.isOpened():
+            raise ValueError(f"无法打开视频文件: {source_path}")
+        tmp_path = self._temp_path(path)
+        writer = None
+        try:
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            if fps <= 0:
+                fps = 30
+            writer = cv2.VideoWriter(tmp_path, cv2.CAP_OPENCV_MJPEG, cv2.VideoWriter_fourcc(*"MJPG"), fps,
+                                     tuple(size), [cv2.VIDEOWRITER_PROP_QUALITY, VIDEO_CACHE_QUALITY])
+            if not writer.isOpened():
+                raise ValueError(f"无法创建视频文件: {tmp_path}")
+
+            frame = None
+            resized = None
+            while True:
+                self._wait_while_paused(cancel_event)
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                ret, frame = cap.read(frame)
+                if not ret:
+                    break
+                if frame.shape[1] == size[0] and frame.shape[0] == size[1]:
+                    writer.write(frame)
+                else:
+                    interpolation = cv2.INTER_AREA if frame.shape[1] > size[0] else cv2.INTER_LINEAR
+                    resized = cv2.resize(frame, tuple(size), dst=resized, interpolation=interpolation)
+                    writer.write(resized)
+            writer.release()
+            writer = None
+            os.replace(tmp_path, path)
+            return True
+        finally:
+            cap.release()
+            if writer is not None:
+                writer.release()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _extract_audio(self, source_path, path):
+        """用 ffmpeg 把源视频的音轨提取为 WAV"""
+        tmp_path = self._temp_path(path)
+        try:
+            cmd = ['ffmpeg', '-i', source_path, '-q:a', '0', '-map', 'a', tmp_path, '-y']
+            subprocess.run(cmd, check=True, capture_output=True)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def get_video_cache():
+    """获取进程内共享的默认视频缓存"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = VideoCache()
+    return _default_cache
\ No newline at end of file
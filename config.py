@@ -43,6 +43,24 @@ RESOURCE_PATHS = {
     "click_sound": "resources/sounds/click.wav"
 }
 
+# 开场视频设置
+VIDEO_FRAME_QUEUE_SIZE = 8  # 后台解码线程提前解码的帧数上限
+
+# 照片导入设置
+UPLOAD_MAX_SIDE = None  # 上传照片的工作分辨率（长边像素），None 表示取封面模板的最大边长
+
+# 美颜设置
+BEAUTIFY_LIVE_PREVIEW = True  # 拖动滑块时在预览尺寸的代理图上实时渲染，离开界面时再渲染原图
+
+# 封面生成并发设置
+COVER_WORKERS = 4          # 并发生成封面的工作者数量，1 表示逐个生成
+COVER_BACKEND = "thread"   # "thread"（线程池）或 "process"（进程池）
+COVER_PREFETCH = False     # 是否在选择主题前为所有主题推测式预生成封面
+COVER_COMPOSITE_MODE = "float64"  # 融合精度: "float64"（原始算法）、"float32" 或 "uint8"（低内存）
+
+# 自定义事件：后台封面生成进度
+COVER_PROGRESS_EVENT = pygame.USEREVENT + 1
+
 # 状态常量
 STATE_VIDEO = "video"
 STATE_MENU = "menu"
@@ -24,15 +24,17 @@ def main():
     clock = pygame.time.Clock()
     
     # 允许文件拖放
-    pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN, pygame.DROPFILE])
+    pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN, pygame.DROPFILE, COVER_PROGRESS_EVENT])
     pygame.scrap.init()
     
     # 创建UI管理器
     ui_manager = UIManager(screen)
     
     # 创建并注册状态
-    ui_manager.register_state(STATE_VIDEO, VideoState())
-    ui_manager.register_state(STATE_MENU, MenuState())
+    video_state = VideoState()
+    menu_state = MenuState()
+    ui_manager.register_state(STATE_VIDEO, video_state)
+    ui_manager.register_state(STATE_MENU, menu_state)
     ui_manager.register_state(STATE_UPLOAD, UploadState())
     ui_manager.register_state(STATE_BEAUTIFY, BeautifyState())
     ui_manager.register_state(STATE_THEME, ThemeState())
@@ -67,6 +69,10 @@ def main():
         # 更新UI
         ui_manager.update()
         
+        # 主菜单空闲时在后台准备开场视频的缓存
+        if ui_manager.current_state is menu_state:
+            video_state.prepare_cache()
+        
         # 绘制
         screen.fill(COLORS["BLACK"])
         ui_manager.draw()
@@ -3,15 +3,91 @@
 """
 import pygame
 import os
-import cv2
+import threading
 from config import *
-from ui_manager import Button, get_font
+from ui_manager import Button, get_font, image_surface
 from api.beautify import FaceBeautifier
+from api.image_ingest import ImageHandle
+from api.video_cache import get_video_cache
+from surface_bridge import reuse_bridge
+
+class FaceDetectionJob:
+    """后台人脸检测任务 - 在工作线程中检测人脸、生成遮罩和预览代理图，结果由 poll() 在主线程中一次性取回"""
+    def __init__(self, beautifier, image, live_preview=True):
+        self.beautifier = beautifier
+        self.image = image  # ImageHandle
+        self.live_preview = live_preview
+        self.cancel_event = threading.Event()
+        
+        # 工作线程写入的结果，由 poll() 在主线程中读取
+        self._lock = threading.Lock()
+        self._stage = "正在检测人脸"
+        self._result = None  # (faces_data, preview_proxy)
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        
+    def start(self):
+        """启动后台检测"""
+        self._thread.start()
+        
+    def cancel(self):
+        """取消检测（已经在运行的 dlib 调用无法中断，其结果会被丢弃）"""
+        self.cancel_event.set()
+        
+    def wait(self, timeout=None):
+        """等待检测结束"""
+        self._thread.join(timeout)
+        
+    @property
+    def stage(self):
+        """当前进度的提示文字"""
+        with self._lock:
+            return self._stage
+        
+    def _set_stage(self, stage):
+        with self._lock:
+            self._stage = stage
+        
+    def _run(self):
+        """工作线程入口"""
+        result = None
+        # 检测期间暂停开场视频的后台转码
+        video_cache = get_video_cache()
+        video_cache.pause()
+        try:
+            faces_data = self.beautifier.detect_faces(self.image.bgr, self.image.digest)
+            if not self.cancel_event.is_set() and faces_data[1]:
+                # 遮罩和预览代理图也在后台生成，主线程拿到结果后即可直接渲染
+                self._set_stage("正在分析五官")
+                self.beautifier.prepare_masks(faces_data[1])
+            preview_proxy = None
+            if not self.cancel_event.is_set() and self.live_preview and faces_data[1]:
+                self._set_stage("正在生成预览")
+                preview_proxy = self.beautifier.create_preview_proxy(*faces_data)
+                self.beautifier.prepare_masks(preview_proxy[1])
+            result = (faces_data, preview_proxy)
+        except Exception as e:
+            print(f"人脸检测失败: {e}")
+        finally:
+            video_cache.resume()
+        with self._lock:
+            self._result = result
+            self._finished = True
+            
+    def poll(self):
+        """
+        检测结束时返回 (True, 结果)，结果为 (faces_data, preview_proxy)，失败时为 None；
+        尚未结束时返回 (False, None)
+        """
+        with self._lock:
+            return self._finished, self._result
 
 class BeautifyState:
     def __init__(self):
+        # 原图和美颜结果都是内存中的 ImageHandle，美颜结果连同已检测的特征点直接交给封面生成
         self.original_image = None
         self.beautified_image = None
+        self.beautified_landmarks = None
         self.just_entered = True
         self.background = None
         
@@ -31,11 +107,20 @@ class BeautifyState:
         self.bright_eyes = 0
         self.red_lips = 0
         
-        # 初始化美颜器（dlib模型作为属性）
-        predictor_path = "./resources/models/shape_predictor_68_face_landmarks.dat"
-        self.beautifier = FaceBeautifier(predictor_path)
+        # 初始化美颜器（dlib模型由 api.face_models 注册表共享，首次检测时加载）
+        self.beautifier = FaceBeautifier()
         self.faces_data = None  # 存储检测到的人脸数据
         
+        # 后台人脸检测：进行中时界面显示进度，滑块和按钮仍可操作，检测完成后再应用
+        self.detect_job = None
+        self.beautify_pending = False  # 检测期间调整了滑块或点击了美颜按钮，结果就绪后需要渲染
+        
+        # 实时预览：预览尺寸的代理图 (proxy_bgr, proxy_faces_data, scale)
+        self.preview_proxy = None
+        self.preview_bridge = None   # 预览 Surface 的 SurfaceBridge，每次渲染复用同一块 Surface
+        self.preview_params = None   # 预览当前显示的美颜参数，None 表示显示原图
+        self.rendered_params = None  # beautified_image 对应的美颜参数，None 表示原图
+        
         # 创建滑块
         self.sliders = []
         self.slider_labels = ["美白", "磨皮", "亮眼", "红唇"]
@@ -91,35 +176,73 @@ class BeautifyState:
         self.label_font = get_font(FONT_MEDIUM)
         self.value_font = get_font(FONT_SMALL)
         
-    def set_original_image(self, image_path):
-        """设置原始图片并立即进行人脸检测"""
-        self.original_image = image_path
-        self.beautified_image = image_path
+    def set_original_image(self, image):
+        """
+        设置原始图片并在后台进行人脸检测（取消上一张图片尚未完成的检测）
+        image: 上传时导入的 ImageHandle
+        """
+        if self.detect_job:
+            self.detect_job.cancel()
+            self.detect_job = None
+        self.beautify_pending = False
+        self.faces_data = None
+        self.original_image = image
+        self.beautified_image = image
+        self.beautified_landmarks = None
+        self.preview_proxy = None
+        self.preview_params = None
+        self.rendered_params = None
+        # 更换图片后旧图片的美颜中间层不再需要
+        self.beautifier.clear_cache()
         try:
-            # 加载图片用于显示
-            img = pygame.image.load(image_path)
-            display_width, display_height = 350, 350
-            img_width, img_height = img.get_size()
-            
-            scale = min(display_width / img_width, display_height / img_height)
-            new_width = int(img_width * scale)
-            new_height = int(img_height * scale)
-            
-            self.original_image_display = pygame.transform.smoothscale(img, (new_width, new_height))
+            # 预览由已解码的图像派生（不再读取文件）
+            self.original_image_display = image_surface(image, (350, 350))
             self.beautified_image_display = self.original_image_display.copy()
             
-            # 立即进行人脸检测（优化关键步骤）
-            if os.path.exists(image_path):
-                self.faces_data = self.beautifier.detect_faces(image_path)
-                # print(f"检测到 {len(self.faces_data[1])} 张人脸")
-            else:
-                print("图片文件不存在")
+            # 人脸检测（含遮罩和预览代理图）在后台线程中进行，不阻塞界面
+            self.detect_job = FaceDetectionJob(self.beautifier, image, BEAUTIFY_LIVE_PREVIEW)
+            self.detect_job.start()
                 
         except Exception as e:
-            print(f"加载图片或人脸检测失败: {e}")
+            print(f"加载图片失败: {e}")
             self.original_image = None
             self.faces_data = None
     
+    def poll_detection(self, wait=False):
+        """
+        检查后台检测是否完成，完成时一次性换入检测结果
+        wait: 是否等待检测结束（离开界面前需要检测结果时使用）
+        """
+        if not self.detect_job:
+            return
+        if wait:
+            self.detect_job.wait()
+        finished, result = self.detect_job.poll()
+        if not finished:
+            return
+        self.detect_job = None
+        if result is None:
+            self.faces_data = None
+            return
+        
+        self.faces_data, self.preview_proxy = result
+        # print(f"检测到 {len(self.faces_data[1])} 张人脸")
+        self.beautified_landmarks = self._first_face_landmarks()
+        
+        # 检测期间调整过的参数在结果就绪后补上
+        if self.beautify_pending:
+            self.beautify_pending = False
+            if BEAUTIFY_LIVE_PREVIEW:
+                self.render_preview()
+            else:
+                self.apply_beautify()
+    
+    def _first_face_landmarks(self):
+        """封面生成使用的人脸特征点（第一张人脸），没有检测到人脸时返回 None"""
+        if self.faces_data and self.faces_data[1]:
+            return self.faces_data[1][0]['landmarks']
+        return None
+    
     def handle_event(self, event, ui_manager):
         """处理事件"""
         if event.type == pygame.QUIT:
@@ -141,6 +264,9 @@ class BeautifyState:
         mouse_pressed = pygame.mouse.get_pressed()
         prev_mouse_pressed = getattr(self, 'prev_mouse_pressed', (False, False, False))
         
+        # 后台检测完成时换入结果
+        self.poll_detection()
+        
         # 更新按钮状态
         self.back_button.update(mouse_pos, mouse_pressed)
         self.next_button.update(mouse_pos, mouse_pressed)
@@ -154,6 +280,15 @@ class BeautifyState:
             
         if self.next_button.is_clicked_now(mouse_pos, mouse_pressed, prev_mouse_pressed):
             ui_manager.play_click_sound()
+            # 渲染原图需要检测结果，检测尚未完成时等待其结束
+            self.poll_detection(wait=True)
+            # 离开界面前按预览的参数渲染原图
+            if BEAUTIFY_LIVE_PREVIEW:
+                self.finalize_beautify()
+            # 照片已确定，开始为所有主题推测式预生成封面（如已开启）
+            prefetcher = getattr(ui_manager.states.get(STATE_LOADING), 'prefetcher', None)
+            if prefetcher and self.beautified_image is not None:
+                prefetcher.start(None, self.beautified_image, self.beautified_landmarks)
             ui_manager.change_state(STATE_THEME)
             
         if self.reset_button.is_clicked_now(mouse_pos, mouse_pressed, prev_mouse_pressed):
@@ -162,15 +297,23 @@ class BeautifyState:
             
         if self.beautify_button.is_clicked_now(mouse_pos, mouse_pressed, prev_mouse_pressed):
             ui_manager.play_click_sound()
-            self.apply_beautify()
+            if self.detect_job:
+                # 检测完成后再应用（按届时的滑块参数渲染）
+                self.beautify_pending = True
+            elif BEAUTIFY_LIVE_PREVIEW:
+                self.render_preview()
+            else:
+                self.apply_beautify()
         
         # 更新滑块
+        slider_changed = False
         if mouse_pressed[0]:
             for i, slider in enumerate(self.sliders):
                 if slider.collidepoint(mouse_pos):
                     # 计算滑块位置对应的值
                     relative_x = mouse_pos[0] - slider.x
                     value = max(0, min(100, int(relative_x / slider.width * 100)))
+                    slider_changed = slider_changed or value != self.slider_values[i]
                     self.slider_values[i] = value
         
         # 更新美颜参数
@@ -179,6 +322,13 @@ class BeautifyState:
         self.bright_eyes = self.slider_values[2]
         self.red_lips = self.slider_values[3]
         
+        # 拖动滑块时实时刷新预览
+        if slider_changed and BEAUTIFY_LIVE_PREVIEW:
+            if self.detect_job:
+                self.beautify_pending = True
+            else:
+                self.render_preview()
+        
         # 更新静音按钮
         if ui_manager.mute_button.update(mouse_pos, mouse_pressed, prev_mouse_pressed):
             ui_manager.play_click_sound()
@@ -191,10 +341,51 @@ class BeautifyState:
         if self.original_image_display:
             self.beautified_image_display = self.original_image_display.copy()
         self.beautified_image = self.original_image
+        self.preview_params = None
+        self.rendered_params = None
+        self.beautify_pending = False
     
-    def apply_beautify(self):
-        """应用美颜效果 - 使用优化后的API"""
-        if self.original_image and self.faces_data:
+    def _current_params(self):
+        """当前滑块对应的美颜参数"""
+        return (self.whitening, self.smoothing, self.bright_eyes, self.red_lips)
+    
+    def render_preview(self):
+        """在预览尺寸的代理图上渲染美颜效果，直接转换为 Surface（不经过磁盘）"""
+        if not self.preview_proxy:
+            return
+        try:
+            proxy_bgr, proxy_faces, scale = self.preview_proxy
+            whitening, smoothing, bright_eyes, red_lips = self._current_params()
+            result_image = self.beautifier.apply_beautify(
+                proxy_bgr,
+                proxy_faces,
+                whitening=whitening,
+                smoothing=smoothing,
+                bright_eyes=bright_eyes,
+                red_lips=red_lips,
+                detail_scale=scale
+            )
+            self.preview_bridge = reuse_bridge(self.preview_bridge, (result_image.shape[1], result_image.shape[0]))
+            self.beautified_image_display = self.preview_bridge.convert(result_image)
+            self.preview_params = self._current_params()
+        except Exception as e:
+            print(f"美颜预览失败: {e}")
+    
+    def finalize_beautify(self):
+        """按预览中的参数渲染原图（只在离开界面时调用，参数未变化时不重复渲染）"""
+        if self.preview_params is None or not any(self.preview_params):
+            # 预览显示的是原图
+            self.reset_beautify()
+            return
+        if self.preview_params != self.rendered_params:
+            self.apply_beautify(update_display=False)
+    
+    def apply_beautify(self, update_display=True):
+        """
+        应用美颜效果 - 使用优化后的API
+        update_display: 是否同时刷新美化后预览（实时预览模式下预览已由代理图渲染）
+        """
+        if self.original_image is not None and self.faces_data:
             try:
                 # 调用美颜API，传入预先检测的人脸数据
                 image_bgr, faces_data_list = self.faces_data
@@ -204,25 +395,18 @@ class BeautifyState:
                     whitening=self.whitening,
                     smoothing=self.smoothing,
                     bright_eyes=self.bright_eyes,
-                    red_lips=self.red_lips
+                    red_lips=self.red_lips,
+                    digest=self.original_image.digest  # 检测时已计算，不再对原图重复计算哈希
                 )
                 
-                # 保存临时结果并加载显示
-                temp_path = "temp/beautified_temp.jpg"
-                os.makedirs("temp", exist_ok=True)
-                cv2.imwrite(temp_path, result_image)
+                # 美颜不改变人脸几何位置，结果和原图的特征点直接留在内存中交给封面生成
+                self.beautified_image = ImageHandle(result_image)
                 
-                # 加载美化后的图片用于显示
-                img = pygame.image.load(temp_path)
-                display_width, display_height = 350, 350
-                img_width, img_height = img.get_size()
+                # 直接由结果派生显示用的 Surface（不再写入临时 JPEG）
+                if update_display:
+                    self.beautified_image_display = image_surface(self.beautified_image, (350, 350))
                 
-                scale = min(display_width / img_width, display_height / img_height)
-                new_width = int(img_width * scale)
-                new_height = int(img_height * scale)
-                
-                self.beautified_image_display = pygame.transform.smoothscale(img, (new_width, new_height))
-                self.beautified_image = temp_path
+                self.rendered_params = self._current_params()
                 
                 # print("美颜效果应用成功")
                 
@@ -330,6 +514,10 @@ class BeautifyState:
             if hasattr(self, 'beautified_image_display') and self.beautified_image_display:
                 screen.blit(self.beautified_image_display, (beaut_x, beaut_y))
             
+            # 后台检测进行中：在美化后预览上显示进度
+            if self.detect_job:
+                self._draw_detect_progress(screen, pygame.Rect(beaut_x, beaut_y, 350, 350))
+            
             # 美化后标签
             beaut_label = self.label_font.render("美化后", True, COLORS["WHITE"])
             beaut_label_rect = beaut_label.get_rect(center=(beaut_x+175, beaut_y+370))
@@ -369,4 +557,24 @@ class BeautifyState:
         self.back_button.draw(screen)
         self.next_button.draw(screen)
         self.reset_button.draw(screen)
-        self.beautify_button.draw(screen)
\ No newline at end of file
+        self.beautify_button.draw(screen)
+    
+    def _draw_detect_progress(self, screen, rect):
+        """绘制检测进度：半透明遮罩 + 旋转的加载指示 + 当前阶段文字"""
+        overlay = pygame.Surface(rect.size, pygame.SRCALPHA)
+        overlay.fill((0, 0, 0, 120))
+        screen.blit(overlay, rect.topleft)
+        
+        ticks = pygame.time.get_ticks()
+        center = (rect.centerx, rect.centery - 20)
+        for i in range(8):
+            # 8 个小圆点按顺序明暗变化，形成旋转效果
+            angle = i * 45
+            brightness = 255 - ((ticks // 100 - i) % 8) * 25
+            offset = pygame.math.Vector2(0, -24).rotate(angle)
+            pygame.draw.circle(screen, (brightness, brightness, brightness),
+                               (int(center[0] + offset.x), int(center[1] + offset.y)), 4)
+        
+        dots = "." * (1 + ticks // 400 % 3)
+        text = self.value_font.render(f"{self.detect_job.stage}{dots:<3}", True, COLORS["WHITE"])
+        screen.blit(text, text.get_rect(center=(rect.centerx, rect.centery + 30)))
\ No newline at end of file
@@ -5,15 +5,20 @@ import pygame
 import os
 from config import *
 from ui_manager import Button, get_font
+from surface_bridge import load_surface
 
 class CoverDisplayState:
     def __init__(self):
         self.theme_show = None
         self.background_surface = None
         self.cover_surface = None
+        # 背景和封面解码后直接写入复用的 Surface（尺寸不变时每张幻灯片不再分配新的 Surface）
+        self.background_bridge = None
+        self.cover_bridge = None
         self.audio_channel = None
         self.animation_start_time = 0
-        self.current_phase = "background"  # background, cover_animation, description, waiting
+        self.current_phase = "background"  # pending, background, cover_animation, description, waiting
+        self.cover_job = None  # 后台封面生成任务（其余封面仍在生成时）
         self.just_entered = True
         self.prev_mouse_pressed = (False, False, False)
         
@@ -30,10 +35,12 @@ class CoverDisplayState:
         self.title_font = get_font(FONT_LARGE)
         self.desc_font = get_font(FONT_SMALL)
         self.button_font = get_font(FONT_SMALL)
+        self.pending_font = get_font(FONT_MEDIUM)
         
-    def set_theme_show(self, theme_show):
-        """设置主题展示数据"""
+    def set_theme_show(self, theme_show, cover_job=None):
+        """设置主题展示数据，cover_job 为仍在后台生成其余封面的任务"""
         self.theme_show = theme_show
+        self.cover_job = cover_job
         self.current_phase = "background"
         self.load_current_slide()
         
@@ -46,11 +53,21 @@ class CoverDisplayState:
         if not slide:
             return
             
+        # 封面尚未生成完成时先等待，保留上一张的背景
+        if self.cover_job and not self.cover_job.is_slide_ready(self.theme_show.current_slide_index):
+            self.current_phase = "pending"
+            self.cover_surface = None
+            if self.audio_channel:
+                self.audio_channel.stop()
+            if self.background_surface is None:
+                self.background_surface = self.create_default_background()
+            return
+            
         # 加载背景图
         try:
             if os.path.exists(slide.background_image):
-                bg_img = pygame.image.load(slide.background_image)
-                self.background_surface = pygame.transform.scale(bg_img, (SCREEN_WIDTH, SCREEN_HEIGHT))
+                self.background_surface, self.background_bridge = load_surface(
+                    slide.background_image, (SCREEN_WIDTH, SCREEN_HEIGHT), self.background_bridge)
             else:
                 self.background_surface = self.create_default_background()
         except:
@@ -59,8 +76,7 @@ class CoverDisplayState:
         # 加载封面图
         try:
             if os.path.exists(slide.cover_image):
-                cover_img = pygame.image.load(slide.cover_image)
-                self.cover_surface = cover_img
+                self.cover_surface, self.cover_bridge = load_surface(slide.cover_image, bridge=self.cover_bridge)
                 self.cover_target_size = (400, 400)
                 self.cover_start_size = (600, 600)
             else:
@@ -106,6 +122,11 @@ class CoverDisplayState:
             ui_manager.change_state(STATE_THEME)
             return True
             
+        if event.type == COVER_PROGRESS_EVENT:
+            if self.cover_job and event.job is self.cover_job:
+                self.cover_job.poll()
+            return False
+            
         return False
         
     def update(self, ui_manager):
@@ -126,6 +147,13 @@ class CoverDisplayState:
         if not slide:
             return
             
+        # 等待中的封面就绪后开始播放该幻灯片
+        if self.cover_job:
+            self.cover_job.poll()
+        if self.current_phase == "pending":
+            if not self.cover_job or self.cover_job.is_slide_ready(self.theme_show.current_slide_index):
+                self.load_current_slide()
+            
         # 更新动画阶段 - 使用slide中的music_duration和animate_duration
         if self.current_phase == "background" and elapsed_time > slide.music_duration:
             self.current_phase = "cover_animation"
@@ -172,7 +200,6 @@ class CoverDisplayState:
             self.load_current_slide()
         else:
             self.cleanup()
-            ui_manager.states["loading"].generated_theme_show = None
             ui_manager.change_state(STATE_THEME)
             
     def cleanup(self):
@@ -180,6 +207,11 @@ class CoverDisplayState:
         if self.audio_channel:
             self.audio_channel.stop()
             
+        # 取消仍在后台生成的封面
+        if self.cover_job:
+            self.cover_job.cancel()
+            self.cover_job = None
+            
     def draw(self, screen):
         """绘制展示界面"""
         if not self.theme_show or not self.background_surface:
@@ -194,6 +226,15 @@ class CoverDisplayState:
         current_time = pygame.time.get_ticks()
         elapsed_time = current_time - self.animation_start_time
         
+        # 绘制等待提示
+        if self.current_phase == "pending":
+            dots = "." * (1 + current_time // 400 % 3)
+            pending_text = f"正在创作下一首歌曲{dots:<3}"
+            pending_shadow = self.pending_font.render(pending_text, True, COLORS["BLUE"])
+            pending_foreground = self.pending_font.render(pending_text, True, COLORS["WHITE"])
+            screen.blit(pending_shadow, pending_shadow.get_rect(center=(SCREEN_WIDTH // 2 + 3, SCREEN_HEIGHT // 2 + 3)))
+            screen.blit(pending_foreground, pending_foreground.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)))
+        
         # 绘制封面动画
         if self.cover_surface and self.current_phase in ["cover_animation", "description", "waiting"]:
             if self.current_phase == "cover_animation":
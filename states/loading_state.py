@@ -3,17 +3,149 @@
 """
 import pygame
 import os
+import threading
 from config import *
 from api.cover_generator import generate_covers
+from api.cover_prefetch import CoverPrefetcher
+from api.video_cache import get_video_cache
+from templates.theme_shows import get_theme_show
+
+class CoverGenerationJob:
+    """后台封面生成任务 - 在工作线程中调用 generate_covers，每张封面就绪时向 pygame 事件队列推送进度"""
+    def __init__(self, theme_id, image_path, prefetcher=None, image=None, landmarks=None):
+        self.theme_id = theme_id
+        self.image_path = image_path
+        # 内存中的用户图像（ImageHandle）及其特征点，提供时不再从 image_path 读取和检测
+        self.image = image
+        self.landmarks = landmarks
+        self.prefetcher = prefetcher
+        self.cancel_event = threading.Event()
+        self.done = False
+        
+        # 工作线程写入的结果，由 poll() 在主线程中读取
+        self._lock = threading.Lock()
+        self._ready_covers = {}  # 幻灯片序号 -> 封面路径
+        self._finished = False
+        
+        # 展示数据只在主线程中修改，封面就绪前 cover_image 为 None
+        self.theme_show = get_theme_show(theme_id)
+        self._default_covers = []
+        if self.theme_show:
+            for slide in self.theme_show.slides:
+                self._default_covers.append(slide.cover_image)
+                slide.cover_image = None
+                
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        
+    def start(self):
+        """启动后台生成"""
+        self._thread.start()
+        
+    def cancel(self):
+        """取消尚未完成的生成"""
+        self.cancel_event.set()
+        
+    def _post_progress(self, slide_index):
+        """向主循环推送进度事件（slide_index 为 None 表示任务结束）"""
+        try:
+            pygame.event.post(pygame.event.Event(COVER_PROGRESS_EVENT, job=self, slide_index=slide_index))
+        except pygame.error:
+            pass
+        
+    def _on_cover(self, slide_index, cover_path):
+        """generate_covers 的回调，在工作线程中执行"""
+        with self._lock:
+            self._ready_covers[slide_index] = cover_path
+        self._post_progress(slide_index)
+        
+    def _follow_prefetch(self, entry):
+        """跟踪预生成条目，把已经（或陆续）生成的封面转交给展示；预生成被取消时返回 False"""
+        forwarded = set()
+        while not self.cancel_event.is_set():
+            covers, done, cancelled = self.prefetcher.wait_entry(entry, len(forwarded))
+            if cancelled:
+                return False
+            for slide_index in sorted(covers):
+                if slide_index not in forwarded:
+                    forwarded.add(slide_index)
+                    self._on_cover(slide_index, covers[slide_index])
+            if done:
+                break
+        return True
+        
+    def _run(self):
+        """工作线程入口"""
+        try:
+            # 优先使用推测式预生成的结果，没有时再自行生成
+            entry = None
+            if self.prefetcher:
+                entry = self.prefetcher.claim(self.theme_id, self.image_path, self.image)
+            if entry is None or not self._follow_prefetch(entry):
+                # 自行生成期间暂停预生成和开场视频的后台转码，前台独占封面生成的 CPU
+                if self.prefetcher:
+                    self.prefetcher.pause()
+                video_cache = get_video_cache()
+                video_cache.pause()
+                try:
+                    generate_covers(self.theme_id, self.image_path,
+                                    workers=COVER_WORKERS, backend=COVER_BACKEND,
+                                    on_cover=self._on_cover, cancel_event=self.cancel_event,
+                                    composite_mode=COVER_COMPOSITE_MODE, landmarks=self.landmarks,
+                                    image=self.image.bgr if self.image is not None else None,
+                                    image_digest=self.image.digest if self.image is not None else None)
+                finally:
+                    video_cache.resume()
+                    if self.prefetcher:
+                        self.prefetcher.resume()
+        except Exception as e:
+            print(f"封面生成失败: {e}")
+        with self._lock:
+            self._finished = True
+        self._post_progress(None)
+        
+    def poll(self):
+        """在主线程中把已就绪的封面写入展示数据，返回任务是否已结束"""
+        with self._lock:
+            ready_covers = dict(self._ready_covers)
+            finished = self._finished
+            
+        if self.theme_show:
+            slides = self.theme_show.slides
+            for slide_index, cover_path in ready_covers.items():
+                if slide_index < len(slides):
+                    slides[slide_index].cover_image = cover_path
+            if finished:
+                # 没有生成封面的幻灯片沿用模板中的默认路径
+                for slide, default_cover in zip(slides, self._default_covers):
+                    if slide.cover_image is None:
+                        slide.cover_image = default_cover
+                        
+        self.done = finished
+        return self.done
+        
+    def is_slide_ready(self, slide_index):
+        """指定幻灯片的封面是否可以展示"""
+        if self.done or not self.theme_show:
+            return True
+        slides = self.theme_show.slides
+        return slide_index >= len(slides) or slides[slide_index].cover_image is not None
+        
+    def ready_count(self):
+        """已就绪的封面数量"""
+        with self._lock:
+            return len(self._ready_covers)
 
 class LoadingState:
     """加载状态"""
     def __init__(self):
-        self.loading_text = "正在创作歌曲..."
+        self.loading_text = "正在创作歌曲"
         self.background = None
         self.just_entered = True
         self.prev_mouse_pressed = (False, False, False)
-        self.generated_theme_show = None
+        self.cover_job = None
+        
+        # 推测式预生成（可选）：美颜完成后为所有主题提前生成封面
+        self.prefetcher = CoverPrefetcher([theme["id"] for theme in THEMES], COVER_COMPOSITE_MODE) if COVER_PREFETCH else None
         
         # 加载背景图片
         if os.path.exists(RESOURCE_PATHS["loading_bg"]):
@@ -27,6 +159,7 @@ class LoadingState:
                 
         # 创建字体
         self.font = pygame.font.SysFont(FONT_NAME, FONT_LARGE)
+        self.progress_font = pygame.font.SysFont(FONT_NAME, FONT_MEDIUM)
         
     def handle_event(self, event, ui_manager):
         """处理事件"""
@@ -36,9 +169,17 @@ class LoadingState:
             return True
             
         if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            # 取消后台生成
+            self.cancel_job()
             ui_manager.change_state(STATE_THEME)
             return True
             
+        if event.type == COVER_PROGRESS_EVENT:
+            # 进度事件只负责唤醒，状态切换在 update 中完成
+            if self.cover_job and event.job is self.cover_job:
+                self.cover_job.poll()
+            return False
+            
         return False
         
     def update(self, ui_manager):
@@ -48,20 +189,25 @@ class LoadingState:
                                                button=1, 
                                                pos=pygame.mouse.get_pos()))
             self.just_entered = False
+            # 每次进入都启动新的后台生成任务
+            self.start_job(ui_manager)
             
-        # 生成数据
-        if not self.generated_theme_show:
-            # 调用API生成封面
-            self.generated_theme_show = self.generate_cover_show(ui_manager)
-            
-        # 数据生成完成后进入展示状态
-        if self.generated_theme_show:
-            if "cover_display" in ui_manager.states:
-                ui_manager.states["cover_display"].set_theme_show(self.generated_theme_show)
-                self.generated_theme_show = None
-                ui_manager.change_state("cover_display")
-            else:
-                ui_manager.change_state(STATE_THEME)
+        # 第一张封面就绪后立即进入展示状态，其余封面在后台继续生成
+        if self.cover_job:
+            self.cover_job.poll()
+            if not self.cover_job.theme_show:
+                if self.cover_job.done:
+                    self.cover_job = None
+                    ui_manager.change_state(STATE_THEME)
+            elif self.cover_job.is_slide_ready(0):
+                if STATE_COVER in ui_manager.states:
+                    # 任务交给展示状态继续跟踪
+                    ui_manager.states[STATE_COVER].set_theme_show(self.cover_job.theme_show, self.cover_job)
+                    self.cover_job = None
+                    ui_manager.change_state(STATE_COVER)
+                else:
+                    self.cancel_job()
+                    ui_manager.change_state(STATE_THEME)
                 
         # 更新静音按钮
         mouse_pos = pygame.mouse.get_pos()
@@ -69,20 +215,30 @@ class LoadingState:
         ui_manager.mute_button.update(mouse_pos, mouse_pressed, self.prev_mouse_pressed)
         self.prev_mouse_pressed = mouse_pressed
         
-    def generate_cover_show(self, ui_manager):
-        """生成专辑封面展示数据"""
+    def start_job(self, ui_manager):
+        """启动后台封面生成任务"""
+        self.cancel_job()
+        
         # 获取当前选择的主题
         current_theme = None
         if hasattr(ui_manager.states[STATE_THEME], 'selected_theme'):
             current_theme = ui_manager.states[STATE_THEME].selected_theme
             
-        # 获取美化后的图片路径
-        beautified_image = None
-        if hasattr(ui_manager.states[STATE_BEAUTIFY], 'beautified_image'):
-            beautified_image = ui_manager.states[STATE_BEAUTIFY].beautified_image
+        # 获取美化后的图片（内存中的 ImageHandle）和已检测的特征点
+        beautify_state = ui_manager.states[STATE_BEAUTIFY]
+        beautified_image = getattr(beautify_state, 'beautified_image', None)
+        beautified_landmarks = getattr(beautify_state, 'beautified_landmarks', None)
             
         # 调用API生成封面
-        return generate_covers(current_theme, beautified_image)
+        self.cover_job = CoverGenerationJob(current_theme, None, self.prefetcher,
+                                            beautified_image, beautified_landmarks)
+        self.cover_job.start()
+        
+    def cancel_job(self):
+        """取消正在进行的生成任务"""
+        if self.cover_job:
+            self.cover_job.cancel()
+            self.cover_job = None
         
     def draw(self, screen):
         """绘制加载界面"""
@@ -96,12 +252,21 @@ class LoadingState:
                 for j in range(0, SCREEN_HEIGHT, 50):
                     pygame.draw.circle(screen, (40, 40, 60), (i, j), 2)
         
-        # 绘制加载文本（白色蓝底效果，与menu_state一致）
-        text = self.font.render(self.loading_text, True, COLORS["WHITE"])
-        text_shadow = self.font.render(self.loading_text, True, COLORS["BLUE"])
+        # 绘制加载文本（白色蓝底效果，与menu_state一致），省略号随时间变化
+        dots = "." * (1 + pygame.time.get_ticks() // 400 % 3)
+        loading_text = f"{self.loading_text}{dots:<3}"
+        text = self.font.render(loading_text, True, COLORS["WHITE"])
+        text_shadow = self.font.render(loading_text, True, COLORS["BLUE"])
         
         text_rect = text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2))
         shadow_rect = text_shadow.get_rect(center=(SCREEN_WIDTH//2 + 3, SCREEN_HEIGHT//2 + 3))
         
         screen.blit(text_shadow, shadow_rect)
-        screen.blit(text, text_rect)
\ No newline at end of file
+        screen.blit(text, text_rect)
+        
+        # 绘制封面生成进度
+        if self.cover_job and self.cover_job.theme_show:
+            progress_text = f"封面 {self.cover_job.ready_count()}/{len(self.cover_job.theme_show.slides)}"
+            progress = self.progress_font.render(progress_text, True, COLORS["LIGHT_GRAY"])
+            progress_rect = progress.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 60))
+            screen.blit(progress, progress_rect)
\ No newline at end of file
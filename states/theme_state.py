@@ -10,6 +10,7 @@ class ThemeState:
     def __init__(self):
         self.background = None
         self.selected_theme = None
+        self.hovered_theme = None
         self.just_entered = True  # 标记是否刚进入该状态
         
         # 加载背景图片
@@ -88,10 +89,19 @@ class ThemeState:
         mouse_pressed = pygame.mouse.get_pressed()
         prev_mouse_pressed = ui_manager.current_state.prev_mouse_pressed if hasattr(ui_manager.current_state, 'prev_mouse_pressed') else (False, False, False)
         
+        # 推测式预生成器（未开启时为 None）
+        prefetcher = getattr(ui_manager.states.get(STATE_LOADING), 'prefetcher', None)
+        
         # 更新歌手主题按钮
         for i, button in enumerate(self.theme_buttons):
             button.update(mouse_pos, mouse_pressed)
             
+            # 悬停的主题优先预生成
+            if button.is_hovered and self.hovered_theme != THEMES[i]["id"]:
+                self.hovered_theme = THEMES[i]["id"]
+                if prefetcher:
+                    prefetcher.prioritize(self.hovered_theme)
+            
             if button.is_clicked_now(mouse_pos, mouse_pressed, prev_mouse_pressed):
                 ui_manager.play_click_sound()
                 self.selected_theme = THEMES[i]["id"]
@@ -4,13 +4,47 @@
 import pygame
 import os
 import math
+import threading
 from config import *
 from ui_manager import Button, FileUploadBox, get_font
+from api.image_ingest import open_image
+
+class ImageImportJob:
+    """后台导入任务 - 在工作线程中把照片解码为工作分辨率的 ImageHandle，结果由 poll() 在主线程中取回"""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        
+        # 工作线程写入的结果，由 poll() 在主线程中读取
+        self._lock = threading.Lock()
+        self._result = None
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        
+    def start(self):
+        """启动后台导入"""
+        self._thread.start()
+        
+    def _run(self):
+        """工作线程入口"""
+        handle = None
+        try:
+            handle = open_image(self.file_path, UPLOAD_MAX_SIDE)
+        except Exception as e:
+            print(f"导入图片失败: {e}")
+        with self._lock:
+            self._result = handle
+            self._finished = True
+            
+    def poll(self):
+        """导入结束时返回 (True, ImageHandle)，失败时为 (True, None)；尚未结束时返回 (False, None)"""
+        with self._lock:
+            return self._finished, self._result
 
 class UploadState:
     def __init__(self):
         self.background = None
         self.selected_file = None
+        self.import_job = None  # 后台导入照片的任务（ImageImportJob），导入结果交给后续各阶段
         self.just_entered = True
         
         # 新增：载入中状态
@@ -81,9 +115,22 @@ class UploadState:
         # 载入中字体
         self.loading_font = get_font(FONT_MEDIUM)
         
+    def select_file(self, file_path):
+        """选择照片：在主线程中以预览尺寸解码并显示预览，工作分辨率的照片在后台导入"""
+        self.upload_box.set_file(file_path)
+        if self.upload_box.image_preview is None:
+            # 无法解码的文件不进入后续流程
+            self.reset()
+            return
+        self.selected_file = file_path
+        self.import_job = ImageImportJob(file_path)
+        self.import_job.start()
+        self.next_button_disabled = False
+        
     def reset(self):
         """重置状态"""
         self.selected_file = None
+        self.import_job = None
         self.next_button_disabled = True
         self.upload_box.set_file(None)
         self.is_loading = False
@@ -99,9 +146,7 @@ class UploadState:
         elif event.type == pygame.DROPFILE:
             file_path = event.file
             if file_path and file_path.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
-                self.selected_file = file_path
-                self.upload_box.set_file(file_path)
-                self.next_button_disabled = False
+                self.select_file(file_path)
                 ui_manager.play_click_sound()
                 
                 # 重要：文件拖放后重置鼠标状态
@@ -113,11 +158,20 @@ class UploadState:
 
     def update(self, ui_manager):
         """更新状态"""
-        # 如果正在载入中，切换到美颜状态
+        # 如果正在载入中，等待后台导入结束后切换到美颜状态
         if self.is_loading:
-            # 将选择的文件传递给美化状态
+            finished, image_handle = self.import_job.poll()
+            if not finished:
+                return
+            if image_handle is None:
+                # 图片未能导入，重置状态
+                self.reset()
+                print("图片导入失败，请重新选择")
+                return
+            
+            # 将已解码的照片传递给美化状态
             if hasattr(ui_manager.states[STATE_BEAUTIFY], 'set_original_image'):
-                ui_manager.states[STATE_BEAUTIFY].set_original_image(self.selected_file)
+                ui_manager.states[STATE_BEAUTIFY].set_original_image(image_handle)
             
             self.is_loading = False
             # 切换到美颜状态
@@ -163,9 +217,7 @@ class UploadState:
                     filetypes=[("图片文件", "*.jpg *.jpeg *.png *.bmp"), ("所有文件", "*.*")]
                 )
                 if file_path:
-                    self.selected_file = file_path
-                    self.upload_box.set_file(file_path)
-                    self.next_button_disabled = False
+                    self.select_file(file_path)
                     
                     # 重要：文件选择对话框后重置鼠标状态
                     ui_manager.current_state.prev_mouse_pressed = (False, False, False)
@@ -173,13 +225,11 @@ class UploadState:
                 print(f"文件选择对话框错误: {e}")
                 file_path = input("请输入图片路径: ").strip('"').strip("'")
                 if file_path and os.path.exists(file_path) and file_path.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
-                    self.selected_file = file_path
-                    self.upload_box.set_file(file_path)
-                    self.next_button_disabled = False
+                    self.select_file(file_path)
                         
         # 检查下一步按钮点击
         if not self.next_button_disabled and self.next_button.is_clicked_now(mouse_pos, mouse_pressed, prev_mouse_pressed):
-            if self.selected_file and os.path.exists(self.selected_file):
+            if self.import_job is not None:
                 ui_manager.play_click_sound()
                 # print(f"选择的文件: {self.selected_file}")
                 
@@ -187,7 +237,7 @@ class UploadState:
                 self.is_loading = True
                 
             else:
-                # 文件不存在，重置状态
+                # 图片未能导入，重置状态
                 self.selected_file = None
                 self.upload_box.set_file(None)
                 self.next_button_disabled = True
@@ -7,8 +7,235 @@ import cv2
 import numpy as np
 import threading
 import time
+from collections import deque
 from config import *
 from ui_manager import Button, get_font
+from surface_bridge import SurfaceBridge
+from api.video_cache import get_video_cache
+
+class VideoFrameDecoder:
+    """
+    后台视频解码线程 - 提前解码帧并直接缩放写入预分配的 Surface，放入有界队列
+    主循环只按播放时钟从队列中取帧，不再等待解码器
+    Surface 由 SurfaceBridge 预先分配 queue_size + 1 块（队列中的帧 + 正在显示的帧）轮流使用，
+    解码缓冲也重复使用，播放过程中不再为每一帧分配内存
+    解码落后于播放时钟时，已经过期的帧用 cap.grab() 跳过（不取出、不转换），避免越落后越忙的恶性循环
+    """
+    def __init__(self, cap, size, start_index=0, queue_size=VIDEO_FRAME_QUEUE_SIZE):
+        self.cap = cap
+        self.size = size  # 输出尺寸 (宽, 高)
+        self.queue_size = queue_size
+        self.bridge = SurfaceBridge(size, count=queue_size + 1)
+        # 视频已经是输出尺寸（如转码缓存）时直接解码到 Surface 的像素内存，不再缩放或拷贝
+        self._direct = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))) == tuple(size)
+        self._free = deque(range(queue_size + 1))  # 可写入的槽位
+        self._frames = deque()  # (帧序号, 槽位)
+        self._shown = None  # 正在显示的槽位（主线程仍在使用，不能覆盖）
+        self._decode_buffer = None  # 重复使用的解码输出数组
+        self._condition = threading.Condition()
+        self._next_index = start_index
+        self._target = start_index  # 播放时钟当前对应的帧序号（由 take 更新）
+        # 同步统计
+        self.dropped = 0  # 没有显示的帧（包括跳过解码的帧）
+        self.grabbed = 0  # 其中用 grab() 跳过、没有取出的帧
+        self.late = 0     # 晚于应显示时刻才显示的帧
+        self._stopped = False
+        self._finished = False  # 解码器已读到视频末尾（或出错）
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        
+    def start(self):
+        """启动后台解码"""
+        self._thread.start()
+        
+    def stop(self):
+        """停止解码并等待线程退出（之后才能释放 VideoCapture）"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+            
+    def _run(self):
+        """工作线程入口：有空闲槽位时解码下一帧"""
+        while True:
+            with self._condition:
+                while not self._free and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                slot = self._free.popleft()
+                index = self._next_index
+                skip = self._target - index
+                
+            try:
+                # 早于播放时钟的帧即使解码出来也会被丢弃，只 grab 不 retrieve
+                skipped = 0
+                ret = True
+                while skipped < skip:
+                    if not self.cap.grab():
+                        ret = False
+                        break
+                    skipped += 1
+                index += skipped
+                if ret and self._direct:
+                    array = self.bridge.arrays[slot]
+                    ret, frame = self.cap.read(array)
+                    if ret and frame is not array:
+                        self.bridge.convert(frame, slot)
+                elif ret:
+                    ret, frame = self.cap.read(self._decode_buffer)
+                    if ret:
+                        self._decode_buffer = frame
+                        self.bridge.convert(frame, slot)
+            except Exception as e:
+                print(f"视频解码失败: {e}")
+                ret = False
+                
+            with self._condition:
+                self.dropped += skipped
+                self.grabbed += skipped
+                if not ret:
+                    self._free.append(slot)
+                    self._finished = True
+                    return
+                self._frames.append((index, slot))
+                self._next_index = index + 1
+                
+    def take(self, index):
+        """
+        取出播放到第 index 帧时应显示的帧：丢弃已经过期的帧，返回序号不超过 index 的最新一帧
+        返回的 Surface 在下一次 take 返回新帧之前保持不变
+        Returns:
+            (帧序号, Surface)，没有新的可显示帧时返回 None
+        """
+        with self._condition:
+            if index != self._target:
+                self._target = index
+                self._condition.notify_all()
+            frame = None
+            while self._frames and self._frames[0][0] <= index:
+                if frame is not None:
+                    self._free.append(frame[1])
+                    self.dropped += 1
+                frame = self._frames.popleft()
+            if frame is None:
+                return None
+            if frame[0] < index:
+                self.late += 1
+            if self._shown is not None:
+                self._free.append(self._shown)
+            self._shown = frame[1]
+            self._condition.notify_all()
+            return frame[0], self.bridge.surface(frame[1])
+            
+    @property
+    def ended(self):
+        """视频已经解码完毕且队列中的帧都已取走"""
+        with self._condition:
+            return self._finished and not self._frames
+            
+    def stats(self):
+        """
+        同步和转换统计
+        Returns:
+            {"dropped", "grabbed", "late", "conversion": 每帧缩放写入 Surface 的耗时，见 ConversionStats.snapshot}
+        """
+        with self._condition:
+            return {
+                "dropped": self.dropped,
+                "grabbed": self.grabbed,
+                "late": self.late,
+                "conversion": self.bridge.stats.snapshot(),
+            }
+
+class VideoPreparationJob:
+    """后台准备开场视频缓存 - 在工作线程中把视频转码为屏幕尺寸并提取音轨，供之后的启动直接播放"""
+    def __init__(self, video_path, size):
+        self.video_path = video_path
+        self.size = size  # 缓存的视频尺寸 (宽, 高)
+        self.cancel_event = threading.Event()
+        
+        # 工作线程写入的结果，由 poll() 读取
+        self._lock = threading.Lock()
+        self._result = None  # (视频路径, 音频路径)
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        
+    def start(self):
+        """启动后台准备"""
+        self._thread.start()
+        
+    def cancel(self):
+        """取消准备（未完成的文件不会进入缓存）"""
+        self.cancel_event.set()
+        
+    def wait(self, timeout=None):
+        """等待准备结束"""
+        self._thread.join(timeout)
+        
+    def _run(self):
+        """工作线程入口"""
+        result = None
+        try:
+            result = get_video_cache().prepare(self.video_path, self.size, self.cancel_event)
+        except Exception as e:
+            print(f"开场视频缓存准备失败: {e}")
+        with self._lock:
+            self._result = result
+            self._finished = True
+            
+    def poll(self):
+        """
+        准备结束时返回 (True, (视频路径, 音频路径))，失败时结果为 None；
+        尚未结束时返回 (False, None)
+        """
+        with self._lock:
+            return self._finished, self._result
+
+class AudioExtractionJob:
+    """后台音轨提取任务 - 在工作线程中用 ffmpeg 提取音轨到缓存，启动时不再等待外部程序"""
+    def __init__(self, video_path):
+        self.video_path = video_path
+        self.cancel_event = threading.Event()
+        
+        # 工作线程写入的结果，由 poll() 读取
+        self._lock = threading.Lock()
+        self._result = None  # 音轨路径
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        
+    def start(self):
+        """启动后台提取"""
+        self._thread.start()
+        
+    def cancel(self):
+        """取消提取（已经在运行的 ffmpeg 会继续完成并写入缓存，本次结果被丢弃）"""
+        self.cancel_event.set()
+        
+    def wait(self, timeout=None):
+        """等待提取结束"""
+        self._thread.join(timeout)
+        
+    def _run(self):
+        """工作线程入口"""
+        result = None
+        try:
+            result = get_video_cache().extract_audio(self.video_path)
+        except Exception as e:
+            print(f"音频提取失败: {e}")
+        with self._lock:
+            self._result = result
+            self._finished = True
+            
+    def poll(self):
+        """
+        提取结束时返回 (True, 音轨路径)，无法提取时路径为 None；
+        尚未结束或已取消时返回 (False, None)
+        """
+        with self._lock:
+            if self.cancel_event.is_set():
+                return False, None
+            return self._finished, self._result
 
 class VideoState:
     def __init__(self):
@@ -18,11 +245,15 @@ class VideoState:
         
         # 视频播放相关属性
         self.cap = None
+        self.decoder = None  # 后台解码线程（VideoFrameDecoder）
         self.video_fps = 30
         self.last_frame_time = 0
         self.video_loaded = False
         self.video_path = None
+        self.cache_ready = False  # 屏幕尺寸的转码缓存和音轨都已就绪
+        self.prepare_job = None  # 后台准备缓存的任务（VideoPreparationJob），由 prepare_cache 在空闲时启动
         self.video_surface = None
+        self.frame_bridge = None  # 第一帧使用的 SurfaceBridge
         self.video_start_time = 0
         self.audio_started = False
         
@@ -30,12 +261,11 @@ class VideoState:
         self.audio_loaded = False
         self.audio_playing = False
         self.audio_started = False
-        self.audio_channel = None
-        self.audio_sound = None
+        self.audio_offset = 0  # 音频开始播放时对应的视频位置（毫秒）
+        self.audio_job = None  # 后台提取音轨的任务（AudioExtractionJob），完成后音频加入播放
         
         # 同步控制
         self.frame_count = 0
-        self.expected_frame_time = 0
         
         # 创建跳过按钮
         self.skip_button = Button(
@@ -63,9 +293,30 @@ class VideoState:
             print(f"视频文件不存在: {video_path}")
             return False
             
+        # 优先使用屏幕尺寸的转码缓存；音轨依次使用缓存中已提取的、视频同目录的 WAV
+        # 查找只读取哈希记录，首次启动时源视频的哈希由后台任务计算，不阻塞第一帧
+        cached_video, audio_path, audio_unavailable = None, None, False
+        try:
+            cache = get_video_cache()
+            cached_video, audio_path = cache.lookup(video_path, (SCREEN_WIDTH, SCREEN_HEIGHT))
+            if audio_path is None:
+                audio_unavailable = cache.audio_unavailable(video_path)
+        except Exception as e:
+            print(f"读取视频缓存失败: {e}")
+        local_audio = video_path.replace('.mp4', '.wav')
+        if audio_path is None and os.path.exists(local_audio):
+            audio_path = local_audio
+        self.cache_ready = cached_video is not None and (audio_path is not None or audio_unavailable)
+            
         try:
             # 使用OpenCV加载视频
-            self.cap = cv2.VideoCapture(video_path)
+            if cached_video:
+                self.cap = cv2.VideoCapture(cached_video)
+                if not self.cap.isOpened():
+                    self.cap.release()
+                    self.cap = None
+            if self.cap is None:
+                self.cap = cv2.VideoCapture(video_path)
             if not self.cap.isOpened():
                 print("无法打开视频文件")
                 return False
@@ -90,8 +341,16 @@ class VideoState:
                 self.video_surface = self.convert_frame_to_surface(frame)
                 self.video_loaded = True
                 
-                # 尝试加载音频
-                self.load_audio(video_path)
+                # 其余帧由后台线程提前解码
+                self.decoder = VideoFrameDecoder(self.cap, (SCREEN_WIDTH, SCREEN_HEIGHT), start_index=1)
+                self.decoder.start()
+                
+                # 尝试加载音频：没有现成的音轨时在后台提取，画面先开始播放
+                if audio_path:
+                    self.load_audio(audio_path)
+                elif not audio_unavailable:
+                    self.audio_job = AudioExtractionJob(video_path)
+                    self.audio_job.start()
                 
                 return True
             else:
@@ -105,22 +364,11 @@ class VideoState:
                 self.cap = None
             return False
     
-    def load_audio(self, video_path):
-        """尝试加载视频中的音频"""
+    def load_audio(self, audio_path):
+        """加载已经提取好的音轨（不在这里运行 ffmpeg，提取由 AudioExtractionJob 在后台完成）"""
         try:
-            # 提取音频文件路径
-            audio_path = video_path.replace('.mp4', '.wav')
-            
-            # 如果音频文件不存在，尝试从视频中提取
-            if not os.path.exists(audio_path):
-                # 使用ffmpeg从视频中提取音频
-                import subprocess
-                cmd = ['ffmpeg', '-i', video_path, '-q:a', '0', '-map', 'a', audio_path, '-y']
-                subprocess.run(cmd, check=True, capture_output=True)
-                # print(f"音频提取成功: {audio_path}")
-            
-            # 加载音频
-            self.audio_sound = pygame.mixer.Sound(audio_path)
+            # 以音乐流方式加载音频：边播放边解码，并能读取已播放的位置作为同步时钟
+            pygame.mixer.music.load(audio_path)
             self.audio_loaded = True
             # print("音频加载成功")
             
@@ -129,53 +377,75 @@ class VideoState:
             self.audio_loaded = False
     
     def convert_frame_to_surface(self, frame):
-        """将OpenCV帧转换为Pygame Surface"""
+        """将OpenCV帧缩放写入预分配的Pygame Surface（与数组共享内存，不交换通道、不拷贝字节串）"""
         try:
-            # 转换BGR到RGB
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            # 调整尺寸
-            frame_resized = cv2.resize(frame_rgb, (SCREEN_WIDTH, SCREEN_HEIGHT))
-            # 转换为Pygame Surface
-            return pygame.image.frombuffer(frame_resized.tobytes(), frame_resized.shape[1::-1], "RGB")
+            if self.frame_bridge is None:
+                self.frame_bridge = SurfaceBridge((SCREEN_WIDTH, SCREEN_HEIGHT))
+            return self.frame_bridge.convert(frame)
         except Exception as e:
             print(f"帧转换失败: {e}")
             return None
     
-    def get_next_frame(self):
-        """获取下一帧视频"""
-        if self.cap and self.cap.isOpened():
-            ret, frame = self.cap.read()
-            if ret:
-                return self.convert_frame_to_surface(frame)
-            else:
-                # 视频播放结束
-                self.video_ended = True
-                self.cap.release()
-                # 停止音频
-                if self.audio_loaded and self.audio_playing:
-                    self.audio_channel.stop()
-                    self.audio_playing = False
-        return None
-    
-    def start_audio(self):
-        """开始播放音频"""
+    def start_audio(self, position=0):
+        """从视频的 position（毫秒）处开始播放音频，使音频与画面对齐"""
         if self.audio_loaded and not self.audio_playing and not self.audio_started:
-            self.audio_channel = self.audio_sound.play()
+            try:
+                pygame.mixer.music.play(start=position / 1000)
+            except pygame.error:
+                # 不支持定位的音频格式从头播放，画面会等待音频时钟追上
+                pygame.mixer.music.play()
+                position = 0
+            self.audio_offset = position
             self.audio_playing = True
             self.audio_started = True
             # print("音频开始播放")
     
     def cleanup(self):
         """清理视频和音频资源"""
+        # 先停止解码线程，再释放 VideoCapture
+        if self.audio_job:
+            self.audio_job.cancel()
+            self.audio_job = None
+        if self.decoder:
+            self.decoder.stop()
+            # print(f"视频同步统计: {self.decoder.stats()}")
+            self.decoder = None
         if self.cap:
             self.cap.release()
             self.cap = None
         
         # 停止音频
         if self.audio_loaded and self.audio_playing:
-            self.audio_channel.stop()
+            pygame.mixer.music.stop()
             self.audio_playing = False
     
+    def prepare_cache(self):
+        """
+        缓存尚未就绪时在后台准备（转码为屏幕尺寸并提取音轨），之后的启动直接播放屏幕尺寸的版本
+        转码耗时较长，不在跳过视频时开始，而由主循环在主菜单空闲时调用；
+        人脸检测和封面生成期间通过 VideoCache.pause() 暂停，重复调用时不会重复启动
+        """
+        if self.video_path and not self.cache_ready and self.prepare_job is None:
+            self.prepare_job = VideoPreparationJob(self.video_path, (SCREEN_WIDTH, SCREEN_HEIGHT))
+            self.prepare_job.start()
+    
+    def playback_position(self, current_time):
+        """
+        当前播放位置（毫秒）：音频播放时以音频已经播放的位置为主时钟，
+        音频尚未开始或已经播完时使用系统时钟（随音频时钟校准，两者之间切换时保持连续）
+        """
+        if self.audio_playing and pygame.mixer.music.get_busy():
+            position = pygame.mixer.music.get_pos()
+            if position >= 0:
+                position += self.audio_offset
+                self.video_start_time = current_time - position
+                return position
+        return current_time - self.video_start_time
+    
+    def stats(self):
+        """播放统计（丢帧、晚到帧、每帧转换耗时），见 VideoFrameDecoder.stats"""
+        return self.decoder.stats() if self.decoder else None
+    
     def handle_event(self, event, ui_manager):
         """处理事件"""
         if event.type == pygame.QUIT:
@@ -204,7 +474,6 @@ class VideoState:
                                                pos=pygame.mouse.get_pos()))
             self.just_entered = False
             self.video_start_time = current_time
-            self.expected_frame_time = current_time
             self.frame_count = 0
         
         # 更新跳过按钮状态
@@ -221,39 +490,28 @@ class VideoState:
             ui_manager.change_state(STATE_MENU)
             
         # 更新视频帧
-        if self.video_loaded and not self.video_ended:
-            # 控制帧率，确保视频播放流畅
-            frame_interval = 1000 / self.video_fps
-            
+        if self.video_loaded and not self.video_ended and self.decoder:
+            # 后台提取的音轨就绪后加载，随后从画面的当前位置加入播放
+            if self.audio_job:
+                finished, audio_path = self.audio_job.poll()
+                if finished:
+                    self.audio_job = None
+                    if audio_path:
+                        self.load_audio(audio_path)
+                        
             # 如果是前3帧之后，再开始音频（给视频缓冲时间）
             if not self.audio_started and self.frame_count >= 3:
-                self.start_audio()
-            
-            # 基于时间戳的帧同步
-            elapsed_time = current_time - self.video_start_time
-            expected_frame = int(elapsed_time * self.video_fps / 1000)
+                self.start_audio(current_time - self.video_start_time)
             
-            # 如果当前帧落后于预期帧，跳过一些帧
-            if self.frame_count < expected_frame - 1:
-                # 跳过落后的帧
-                skip_frames = expected_frame - self.frame_count - 1
-                for _ in range(skip_frames):
-                    ret, _ = self.cap.read()
-                    if not ret:
-                        break
-                    self.frame_count += 1
-                # print(f"跳过 {skip_frames} 帧以追赶音频")
-            
-            # 获取当前帧
-            if current_time >= self.expected_frame_time:
-                frame = self.get_next_frame()
-                if frame is not None:
-                    self.video_surface = frame
-                    self.frame_count += 1
-                    self.expected_frame_time += frame_interval
-                else:
-                    # 视频播放结束
-                    self.video_ended = True
+            # 基于播放时钟的帧同步：取出当前时刻应显示的帧，落后时过期的帧直接丢弃或跳过解码
+            expected_frame = int(self.playback_position(current_time) * self.video_fps / 1000)
+            frame = self.decoder.take(expected_frame)
+            if frame is not None:
+                index, self.video_surface = frame
+                self.frame_count = index + 1
+            elif self.decoder.ended:
+                # 视频播放结束
+                self.video_ended = True
         else:
             # 如果没有视频，直接结束
             if not self.video_loaded:
@@ -271,9 +529,9 @@ class VideoState:
             # 控制音频静音
             if self.audio_loaded and self.audio_playing:
                 if ui_manager.mute_button.is_muted:
-                    self.audio_channel.set_volume(0)
+                    pygame.mixer.music.set_volume(0)
                 else:
-                    self.audio_channel.set_volume(1.0)
+                    pygame.mixer.music.set_volume(1.0)
                     
         # 保存当前鼠标状态
         self.prev_mouse_pressed = mouse_pressed
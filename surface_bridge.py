@@ -0,0 +1,100 @@
+"""
+ndarray → Surface 桥接 - 把 OpenCV 的 BGR 数组直接写进预分配的 Surface
+
+pygame.image.frombuffer 以 "BGR" 格式创建的 Surface 与 numpy 数组共享同一块内存，
+因此转换只需要一次 cv2.resize（dst 指向 Surface 的像素内存）或一次拷贝：
+不做 BGR→RGB 通道交换，不经过 tobytes() 的中间字节串，也不为每一帧分配新的 Surface。
+SurfaceBridge 持有若干块这样的 Surface 轮流使用（视频解码线程写一块、主线程显示另一块），
+并记录每次转换的耗时，用于确认开场视频能以原始帧率在 1280×720 下播放。
+"""
+import threading
+import time
+import cv2
+import numpy as np
+import pygame
+
+
+class ConversionStats:
+    """转换耗时统计（线程安全）"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds):
+        """记录一次转换的耗时（秒）"""
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.last = seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        """返回 {"count", "mean_ms", "max_ms", "last_ms"}"""
+        with self._lock:
+            return {
+                "count": self.count,
+                "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+                "max_ms": self.max * 1000,
+                "last_ms": self.last * 1000,
+            }
+
+class SurfaceBridge:
+    """
+    把 BGR 数组写入预分配 Surface 的转换器
+    size: Surface 尺寸 (宽, 高)；count: 轮流使用的 Surface 数量，每块对应一个槽位
+    """
+    def __init__(self, size, count=1):
+        self.size = (int(size[0]), int(size[1]))
+        self.arrays = []
+        self.surfaces = []
+        for _ in range(count):
+            array = np.zeros((self.size[1], self.size[0], 3), dtype=np.uint8)
+            self.arrays.append(array)
+            # Surface 直接引用 array 的内存，写入 array 即更新 Surface
+            self.surfaces.append(pygame.image.frombuffer(array, self.size, "BGR"))
+        self.stats = ConversionStats()
+
+    def convert(self, image, slot=0, interpolation=cv2.INTER_LINEAR):
+        """
+        把 BGR 图像缩放写入第 slot 块 Surface 并返回该 Surface
+        尺寸相同时只拷贝一次，否则由 cv2.resize 直接输出到 Surface 的像素内存
+        """
+        start_time = time.perf_counter()
+        array = self.arrays[slot]
+        if image.shape[:2] == array.shape[:2]:
+            np.copyto(array, image)
+        else:
+            cv2.resize(image, self.size, dst=array, interpolation=interpolation)
+        self.stats.record(time.perf_counter() - start_time)
+        return self.surfaces[slot]
+
+    def surface(self, slot=0):
+        """第 slot 块 Surface"""
+        return self.surfaces[slot]
+
+def reuse_bridge(bridge, size):
+    """尺寸不变时复用 bridge，否则创建新的单块 SurfaceBridge（尺寸变化时才分配内存）"""
+    if bridge is None or bridge.size != tuple(size):
+        return SurfaceBridge(size)
+    return bridge
+
+def load_surface(image_path, size=None, bridge=None):
+    """
+    用 OpenCV 解码图片文件并写入 Surface（路径中含非 ASCII 字符时同样可用）
+    size: 输出尺寸 (宽, 高)，None 表示保持原图尺寸
+    bridge: 可选，复用的 SurfaceBridge（尺寸不同时会重新创建）
+    Returns:
+        (Surface, 使用的 SurfaceBridge)，无法解码时抛出 ValueError
+    """
+    image_bgr = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image_bgr is None:
+        raise ValueError(f"无法读取图片: {image_path}")
+    if size is None:
+        size = (image_bgr.shape[1], image_bgr.shape[0])
+    bridge = reuse_bridge(bridge, size)
+    interpolation = cv2.INTER_AREA if image_bgr.shape[1] > size[0] else cv2.INTER_LINEAR
+    return bridge.convert(image_bgr, interpolation=interpolation), bridge
\ No newline at end of file
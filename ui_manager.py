@@ -2,8 +2,11 @@
 UI管理器和基础UI组件
 """
 import os
+import cv2
 import pygame
 from config import *
+from api.image_ingest import decode_preview, fit_size
+from surface_bridge import SurfaceBridge
 
 # 获取字体的辅助函数
 def get_font(size, bold=False, italic=False):
@@ -15,6 +18,14 @@ def get_font(size, bold=False, italic=False):
         font = pygame.font.SysFont(None, size, bold, italic)
     return font
 
+def image_surface(image, max_size):
+    """ImageHandle 的预览 Surface：按比例缩放到恰好放进 max_size (宽, 高)，由 ImageHandle 缓存"""
+    def compute():
+        new_size = fit_size(image.size, max_size)
+        interpolation = cv2.INTER_AREA if new_size[0] < image.size[0] else cv2.INTER_LINEAR
+        return SurfaceBridge(new_size).convert(image.bgr, interpolation=interpolation)
+    return image.derive(("surface", tuple(max_size)), compute)
+
 class Button:
     """按钮组件"""
     def __init__(self, x, y, width, height, text, 
@@ -126,26 +137,14 @@ class FileUploadBox:
         self.hint_font = get_font(FONT_SMALL)
         
     def set_file(self, file_path):
-        """设置选择的文件，并加载图片预览"""
+        """设置选择的文件，并以预览尺寸解码图片预览（JPEG 按缩小倍数解码，不解码工作分辨率的整图）"""
         self.file_path = file_path
         if file_path:
             self.file_name = os.path.basename(file_path)
-            # 加载图片预览
+            # 加载图片预览（保持纵横比，适应框的大小）
             try:
-                image = pygame.image.load(file_path)
-                # 计算缩放比例，保持纵横比
-                image_width, image_height = image.get_size()
-                
-                # 计算缩放比例，使图片适应框的大小
-                scale = min(
-                    (self.rect.width - 40) / image_width,
-                    (self.rect.height - 60) / image_height
-                )
-                new_width = int(image_width * scale)
-                new_height = int(image_height * scale)
-                
-                # 缩放图片
-                self.image_preview = pygame.transform.smoothscale(image, (new_width, new_height))
+                preview_bgr = decode_preview(file_path, (self.rect.width - 40, self.rect.height - 60))
+                self.image_preview = SurfaceBridge((preview_bgr.shape[1], preview_bgr.shape[0])).convert(preview_bgr)
                 
             except Exception as e:
                 print(f"加载图片失败: {e}")